@@ -152,3 +152,22 @@ class TestDirListing(unittest.TestCase):
 
         self.assertEquals(test_object.is_file, False)
         self.assertEquals(test_object.is_dir, True)
+
+    def test_file_records_are_compact_and_share_strings(self):
+        test_object = self.test_class()
+
+        # Built at runtime so that they're distinct objects before interning
+        user = ''.join(['user', 'name'])
+        other_user = ''.join(['user', 'name'])
+
+        first = test_object.add_file('file1', None, 1, user, 10, 'group', 100,
+                                     False)
+        second = test_object.add_file('file2', None, 1, other_user, 10, 'group',
+                                      100, False)
+
+        self.assertFalse(hasattr(first, '__dict__'))
+        self.assertFalse(hasattr(test_object, '__dict__'))
+        self.assertIs(first.uname, second.uname)
+
+        self.assertEquals(first.size, None)
+        self.assertEquals(first.mtime, None)
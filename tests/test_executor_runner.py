@@ -17,11 +17,13 @@
 #   USA
 
 import imp
+import threading
 import unittest
 
 from mock import Mock
 from time import sleep
 from multiprocessing import cpu_count
+from os import getpid, path
 
 class TestExecutorRunner(unittest.TestCase):
     # Dashes are standard for exec scipts but not allowed for modules in Python. We
@@ -115,3 +117,183 @@ class TestExecutorRunner(unittest.TestCase):
             self.assertEquals(str(re), 'Big crash!')
         except Exception as e:
             self.fail('Unexpected exception thrown')
+
+    def test_callback_gets_the_result_of_each_task(self):
+        test_object = self.test_class()
+
+        def task_method(number, letter):
+            return '%d%s' % (number, letter)
+
+        results = []
+        test_object.add_task(task_method, (1, 'a'), results.append)
+        test_object.add_task(task_method, (2, 'b'), results.append)
+
+        test_object.join_all()
+
+        self.assertEqual(sorted(results), ['1a', '2b'])
+
+    def test_if_callback_fails_join_all_fails(self):
+        test_object = self.test_class()
+
+        def task_method(number, letter):
+            return number
+
+        def callback(result):
+            raise RuntimeError('Callback crash!')
+
+        test_object.add_task(task_method, (1, 'a'), callback)
+
+        try:
+            test_object.join_all()
+
+            raise Exception()
+        except RuntimeError as re:
+            self.assertEquals(str(re), 'Callback crash!')
+        except Exception as e:
+            self.fail('Unexpected exception thrown')
+
+    def test_add_task_blocks_while_too_many_tasks_are_pending(self):
+        test_object = self.test_class(max_pending = 2)
+
+        lock = threading.Lock()
+        running = [0]
+        max_running = [0]
+        def task_method(number, letter):
+            with lock:
+                running[0] += 1
+                max_running[0] = max(max_running[0], running[0])
+
+            sleep(0.05)
+
+            with lock:
+                running[0] -= 1
+
+        for number in range(8):
+            test_object.add_task(task_method, (number, 'a'))
+
+            self.assertLessEqual(len(test_object.pending), 2)
+
+        test_object.join_all()
+
+        self.assertLessEqual(max_running[0], 2)
+
+    def test_completed_tasks_are_released(self):
+        test_object = self.test_class()
+
+        def task_method(number, letter):
+            return number
+
+        for number in range(10):
+            test_object.add_task(task_method, (number, 'a'))
+
+        test_object.join_all()
+
+        self.assertEqual(0, len(test_object.pending))
+
+    def test_first_failure_cancels_queued_tasks(self):
+        test_object = self.test_class()
+        thread_count = test_object.executor._max_workers
+
+        started = threading.Event()
+        values_ran = []
+        def task_method(number, letter):
+            started.wait()
+
+            if number == 0:
+                raise RuntimeError('Big crash!')
+
+            # Keeps the other threads busy until the failure is handled
+            sleep(0.2)
+            values_ran.append(number)
+
+        try:
+            for number in range(thread_count + 10):
+                test_object.add_task(task_method, (number, 'a'))
+
+            started.set()
+            test_object.join_all()
+
+            raise Exception()
+        except RuntimeError as re:
+            self.assertEquals(str(re), 'Big crash!')
+        except Exception as e:
+            self.fail('Unexpected exception thrown')
+
+        # Only the tasks that were already running got to finish
+        self.assertEqual(sorted(values_ran), list(range(1, thread_count)))
+
+    def test_add_task_fails_once_a_task_failed(self):
+        test_object = self.test_class()
+
+        def failing_method(number, letter):
+            raise RuntimeError('Big crash!')
+
+        def task_method(number, letter):
+            self.fail('Should not have been run')
+
+        test_object.add_task(failing_method, (1, 'a'))
+
+        # Give the failure time to be noticed
+        sleep(0.2)
+
+        with self.assertRaises(RuntimeError) as error:
+            test_object.add_task(task_method, (2, 'b'))
+
+        self.assertEqual(str(error.exception), 'Big crash!')
+
+    def test_process_mode_runs_tasks_in_other_processes(self):
+        test_object = self.test_class(jobs = 2, mode = 'process')
+        self.assertTrue(test_object.uses_processes)
+
+        pids = []
+        for number in range(6):
+            test_object.add_task(getpid, (), pids.append)
+
+        test_object.join_all()
+
+        self.assertEqual(len(pids), 6)
+        self.assertNotIn(getpid(), pids)
+
+    def test_process_mode_does_not_fork_the_caller(self):
+        test_object = self.test_class(jobs = 2, mode = 'process')
+        test_object.start_workers()
+
+        self.assertEqual('forkserver',
+                         test_object.executor._mp_context.get_start_method())
+
+        test_object.join_all()
+
+    def test_process_mode_raises_task_errors(self):
+        test_object = self.test_class(jobs = 2, mode = 'process')
+
+        test_object.add_task(int, ('not a number',))
+
+        with self.assertRaises(ValueError):
+            test_object.join_all()
+
+    def test_archive_refs_open_one_archive_per_process(self):
+        archive_path = path.join('tests', 'test_files', 'tar_impl',
+                                 'new_version1.tgz')
+
+        with self.patcher.XDeltaArchive(archive_path) as archive_object:
+            listings = self.patcher.ArchiveRef.listing_of(archive_path,
+                                                          archive_object)
+
+        self.patcher.ArchiveRef.init_worker(listings)
+        try:
+            archive_ref = self.patcher.ArchiveRef(archive_path)
+            archive_object = self.patcher.resolve_archive(archive_ref)
+
+            # Preloaded listings are used instead of reading the archive
+            self.assertEqual(archive_object.list_items(),
+                             listings[path.abspath(archive_path)])
+
+            self.assertIs(archive_object,
+                          self.patcher.resolve_archive(
+                              self.patcher.ArchiveRef(archive_path)))
+            self.assertIs(archive_object,
+                          self.patcher.resolve_archive(archive_object))
+
+            archive_object.close()
+        finally:
+            self.patcher.ArchiveRef.init_worker({})
@@ -102,4 +102,4 @@ class TestHelpers(object):
 
         for filename in files:
             test_class.assertTrue(isinstance(actual_members[filename],
-                                             patcher.AttributeDict))
+                                             patcher.FileEntry))
@@ -0,0 +1,178 @@
+#    xdelta3-dir-patcher
+#    Copyright (C) 2014-2015 Endless Mobile
+#
+#   This library is free software; you can redistribute it and/or
+#   modify it under the terms of the GNU Lesser General Public
+#   License as published by the Free Software Foundation; either
+#   version 2.1 of the License, or (at your option) any later version.
+#
+#   This library is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#   Lesser General Public License for more details.
+#
+#   You should have received a copy of the GNU Lesser General Public
+#   License along with this library; if not, write to the Free Software
+#   Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301
+#   USA
+
+import imp
+import json
+import unittest
+
+from mock import Mock
+from shutil import rmtree, copyfile, copytree
+from tempfile import mkdtemp
+from os import listdir, path, utime
+
+from .test_helpers import TestHelpers
+
+class TestScanCache(unittest.TestCase):
+    # Dashes are standard for exec scipts but not allowed for modules in Python. We
+    # use the script standard since we will be running that file as a script most
+    # often.
+    patcher = imp.load_source("xdelta3-dir-patcher", "xdelta3-dir-patcher")
+
+    TEST_FILE_PREFIX = path.join('tests', 'test_files', 'tar_impl')
+
+    def setUp(self):
+        self.temp_dir = mkdtemp(prefix="%s_" % self.__class__.__name__)
+        self.cache_dir = path.join(self.temp_dir, 'cache')
+
+        self.test_class = self.patcher.ScanCache
+
+    def tearDown(self):
+        rmtree(self.temp_dir)
+
+    # Helpers
+    def copy_test_file(self, name):
+        target = path.join(self.temp_dir, name)
+        source = path.join(self.TEST_FILE_PREFIX, name)
+
+        if path.isdir(source):
+            copytree(source, target, symlinks = True)
+        else:
+            copyfile(source, target)
+
+        return target
+
+    # Tests
+    def test_archive_listing_and_hashes_are_reused(self):
+        archive = self.copy_test_file('new_version1.tgz')
+        test_object = self.test_class(self.cache_dir)
+
+        with self.patcher.XDeltaArchive(archive, test_object) as archive_object:
+            expected_hash = archive_object.hash_member('long_lorem.txt')
+
+        with self.patcher.XDeltaArchive(archive, test_object) as archive_object:
+            archive_object.archive_object.getmembers = Mock(side_effect = Exception())
+            archive_object.open_member = Mock(side_effect = Exception())
+
+            TestHelpers.verify_new_version1_members(self, self.patcher,
+                                                    archive_object.list_items())
+            self.assertEqual(expected_hash,
+                             archive_object.hash_member('long_lorem.txt'))
+
+            # Cached members still have what's needed to extract them
+            archive_object.expand('new folder/new file1.txt', self.temp_dir)
+
+        expanded_path = path.join(self.temp_dir, 'new folder', 'new file1.txt')
+        self.assertEqual(b'new file content\n',
+                         TestHelpers.get_content(expanded_path))
+
+    def test_zip_listing_is_reused(self):
+        archive = path.join(self.temp_dir, 'new_version1.zip')
+        copyfile(path.join('tests', 'test_files', 'zip_impl', 'new_version1.zip'),
+                 archive)
+        test_object = self.test_class(self.cache_dir)
+
+        with self.patcher.XDeltaArchive(archive, test_object) as archive_object:
+            archive_object.list_items()
+
+        with self.patcher.XDeltaArchive(archive, test_object) as archive_object:
+            archive_object.archive_object.namelist = Mock(side_effect = Exception())
+
+            TestHelpers.verify_new_version1_members(self, self.patcher,
+                                                    archive_object.list_items())
+
+            archive_object.expand('new folder/new file1.txt', self.temp_dir)
+
+        expanded_path = path.join(self.temp_dir, 'new folder', 'new file1.txt')
+        self.assertEqual(b'new file content\n',
+                         TestHelpers.get_content(expanded_path))
+
+    def test_entries_are_stored_as_json(self):
+        archive = self.copy_test_file('new_version1.tgz')
+        test_object = self.test_class(self.cache_dir)
+
+        with self.patcher.XDeltaArchive(archive, test_object) as archive_object:
+            expected_hash = archive_object.hash_member('long_lorem.txt')
+
+        entry_path = test_object._entry_path(test_object._key(archive))
+        with open(entry_path, 'r') as entry_file:
+            cached = json.load(entry_file)
+
+        self.assertEqual([None, expected_hash],
+                         cached['hashes']['long_lorem.txt'])
+        self.assertIn('long_lorem.txt',
+                      [record[0] for record in cached['members']])
+
+    def test_modified_archives_are_not_served_from_the_cache(self):
+        archive = self.copy_test_file('new_version1.tgz')
+        test_object = self.test_class(self.cache_dir)
+
+        with self.patcher.XDeltaArchive(archive, test_object) as archive_object:
+            archive_object.hash_member('long_lorem.txt')
+
+        utime(archive, (1, 1))
+
+        entry = test_object.lookup(archive)
+        self.assertIsNone(entry.records)
+        self.assertEqual({}, entry.hashes)
+
+    def test_folder_hashes_are_checked_against_each_file(self):
+        folder = self.copy_test_file('new_version1')
+        test_object = self.test_class(self.cache_dir)
+
+        with self.patcher.XDeltaArchive(folder, test_object) as archive_object:
+            archive_object.hash_member('long_lorem.txt')
+            archive_object.hash_member('short_lorem.txt')
+
+        with open(path.join(folder, 'short_lorem.txt'), 'a') as changed_file:
+            changed_file.write('more')
+
+        with self.patcher.XDeltaArchive(folder, test_object) as archive_object:
+            archive_object.open_member = Mock(wraps = archive_object.open_member)
+
+            archive_object.hash_member('long_lorem.txt')
+            archive_object.hash_member('short_lorem.txt')
+
+            archive_object.open_member.assert_called_once_with('short_lorem.txt')
+
+    def test_least_recently_used_entries_are_evicted(self):
+        test_object = self.test_class(self.cache_dir)
+
+        archives = []
+        for index in range(3):
+            archive = path.join(self.temp_dir, 'archive%d.tgz' % index)
+            copyfile(path.join(self.TEST_FILE_PREFIX, 'new_version1.tgz'),
+                     archive)
+            archives.append(archive)
+
+            entry = test_object.lookup(archive)
+            test_object.store(entry, [])
+
+            # Use times that are distinct from each other
+            entry_path = test_object._entry_path(entry.key)
+            utime(entry_path, (index + 1, index + 1))
+
+        # Using the oldest one makes the second one the least recently used
+        test_object.lookup(archives[0])
+
+        test_object.max_entries = 2
+        test_object.evict()
+
+        self.assertEqual(2, len(listdir(self.cache_dir)))
+        self.assertIsNotNone(test_object.lookup(archives[0]).records)
+        self.assertIsNone(test_object.lookup(archives[1]).records)
+        self.assertIsNotNone(test_object.lookup(archives[2]).records)
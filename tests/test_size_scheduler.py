@@ -0,0 +1,106 @@
+#    xdelta3-dir-patcher
+#    Copyright (C) 2014-2015 Endless Mobile
+#
+#   This library is free software; you can redistribute it and/or
+#   modify it under the terms of the GNU Lesser General Public
+#   License as published by the Free Software Foundation; either
+#   version 2.1 of the License, or (at your option) any later version.
+#
+#   This library is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#   Lesser General Public License for more details.
+#
+#   You should have received a copy of the GNU Lesser General Public
+#   License along with this library; if not, write to the Free Software
+#   Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301
+#   USA
+
+import imp
+import unittest
+
+from mock import Mock
+
+class TestSizeScheduler(unittest.TestCase):
+    # Dashes are standard for exec scipts but not allowed for modules in Python. We
+    # use the script standard since we will be running that file as a script most
+    # often.
+    patcher = imp.load_source("xdelta3-dir-patcher", "xdelta3-dir-patcher")
+
+    def setUp(self):
+        self.test_class = self.patcher.SizeScheduler
+
+        # Runs tasks right away in the order they are sent
+        self.sent = []
+        def add_task(target_func, target_func_args, callback = None):
+            self.sent.append((target_func, target_func_args))
+            result = target_func(*target_func_args)
+            if callback:
+                callback(result)
+
+        self.runner = Mock()
+        self.runner.add_task = Mock(side_effect = add_task)
+
+    def tearDown(self):
+        pass
+
+    def task_method(self, name):
+        return name.upper()
+
+    def test_large_tasks_are_sent_right_away(self):
+        test_object = self.test_class(self.runner)
+        large = self.test_class.SMALL_TASK_SIZE
+
+        test_object.add_task(large, self.task_method, ('a',))
+        test_object.add_task(1, self.task_method, ('b',))
+        test_object.add_task(large * 2, self.task_method, ('c',))
+
+        # Small tasks wait for a batch
+        self.assertEqual([args for func, args in self.sent], [('a',), ('c',)])
+
+        test_object.flush()
+
+        self.assertEqual([args for func, args in self.sent],
+                         [('a',), ('c',), ('b',)])
+
+    def test_small_tasks_are_batched(self):
+        test_object = self.test_class(self.runner)
+        results = []
+
+        for index in range(self.test_class.BATCH_LENGTH + 1):
+            test_object.add_task(1, self.task_method, ('small%d' % index,),
+                                 results.append)
+        test_object.add_task(self.test_class.SMALL_TASK_SIZE,
+                             self.task_method, ('large',), results.append)
+
+        test_object.flush()
+
+        self.assertEqual(len(self.sent), 3)
+        self.assertEqual(self.sent[0][0], self.patcher.run_batch)
+        self.assertEqual(len(self.sent[0][1][0]), self.test_class.BATCH_LENGTH)
+        self.assertEqual(self.sent[1], (self.task_method, ('large',)))
+
+        # The last leftover doesn't need a batch of its own
+        self.assertEqual(self.sent[2], (self.task_method,
+                                        ('small%d' % self.test_class.BATCH_LENGTH,)))
+
+        # Every task still gets its own callback
+        self.assertEqual(results,
+                         ['SMALL%d' % index
+                          for index in range(self.test_class.BATCH_LENGTH)] +
+                         ['LARGE',
+                          'SMALL%d' % self.test_class.BATCH_LENGTH])
+
+    def test_batches_are_bounded_by_size(self):
+        test_object = self.test_class(self.runner)
+        size = self.test_class.SMALL_TASK_SIZE - 1
+
+        # The batch is sent once it reaches BATCH_SIZE
+        task_count = self.test_class.BATCH_SIZE // size + 2
+        for index in range(task_count):
+            test_object.add_task(size, self.task_method, ('small%d' % index,))
+
+        test_object.flush()
+
+        self.assertEqual(len(self.sent), 2)
+        self.assertEqual(len(self.sent[0][1][0]), task_count - 1)
@@ -45,3 +45,9 @@ class TestXDelta3AbstractArchiveImp(unittest.TestCase):
     def test_list_items_is_a_passthrough_to_members_property(self):
         test_object = self.MockArchiveImpl(self)
         self.assertEquals(test_object.list_items(), "abc")
+
+    def test_stream_items_defaults_to_requested_order_without_expanding(self):
+        test_object = self.MockArchiveImpl(self)
+
+        self.assertEqual([('b', False), ('a', False)],
+                         list(test_object.stream_items(['b', 'a'], '/foo')))
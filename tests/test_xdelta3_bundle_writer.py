@@ -0,0 +1,174 @@
+#    xdelta3-dir-patcher
+#    Copyright (C) 2014-2015 Endless Mobile
+#
+#   This library is free software; you can redistribute it and/or
+#   modify it under the terms of the GNU Lesser General Public
+#   License as published by the Free Software Foundation; either
+#   version 2.1 of the License, or (at your option) any later version.
+#
+#   This library is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#   Lesser General Public License for more details.
+#
+#   You should have received a copy of the GNU Lesser General Public
+#   License along with this library; if not, write to the Free Software
+#   Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301
+#   USA
+
+import imp
+import tarfile
+import unittest
+
+from shutil import rmtree
+from tempfile import mkdtemp
+from io import BytesIO
+from os import path, makedirs, symlink, urandom
+
+from .test_helpers import TestHelpers
+
+class TestXDelta3BundleWriter(unittest.TestCase):
+    # Dashes are standard for exec scipts but not allowed for modules in Python. We
+    # use the script standard since we will be running that file as a script most
+    # often.
+    patcher = imp.load_source("xdelta3-dir-patcher", "xdelta3-dir-patcher")
+
+    def setUp(self):
+        self.temp_dir = mkdtemp(prefix="%s_" % self.__class__.__name__)
+        self.bundle_path = path.join(self.temp_dir, 'bundle.tgz')
+
+        self.test_class = self.patcher.XDelta3BundleWriter
+
+    def tearDown(self):
+        rmtree(self.temp_dir)
+
+    # Helpers
+    def create_file(self, name, content):
+        file_path = path.join(self.temp_dir, name)
+        with open(file_path, 'wb') as file_handle:
+            file_handle.write(content)
+
+        return file_path
+
+    # Tests
+    def test_added_items_end_up_in_bundle(self):
+        folder_path = path.join(self.temp_dir, 'folder')
+        makedirs(folder_path)
+        file_path = self.create_file('file', b'content')
+        link_path = path.join(self.temp_dir, 'link')
+        symlink('file', link_path)
+
+        with self.test_class(self.bundle_path) as test_object:
+            test_object.add(folder_path, 'xdelta')
+            test_object.add(file_path, 'xdelta/file')
+            test_object.add(link_path, 'xdelta/link')
+
+        with tarfile.open(self.bundle_path) as archive_object:
+            self.assertEqual(['xdelta', 'xdelta/file', 'xdelta/link'],
+                             archive_object.getnames())
+
+            self.assertTrue(archive_object.getmember('xdelta').isdir())
+            self.assertEqual(b'content',
+                             archive_object.extractfile('xdelta/file').read())
+            self.assertEqual('file',
+                             archive_object.getmember('xdelta/link').linkname)
+
+    def test_sources_are_removed_once_written_unless_asked_not_to(self):
+        file_path = self.create_file('file', b'content')
+        kept_file_path = self.create_file('kept_file', b'content')
+
+        with self.test_class(self.bundle_path) as test_object:
+            test_object.add(file_path, 'file')
+            test_object.add(kept_file_path, 'kept_file', remove_source = False)
+
+        self.assertFalse(path.exists(file_path))
+        self.assertTrue(path.exists(kept_file_path))
+
+    def test_bundle_is_removed_if_writing_is_aborted(self):
+        file_path = self.create_file('file', b'content')
+
+        try:
+            with self.test_class(self.bundle_path) as test_object:
+                test_object.add(file_path, 'file')
+
+                raise RuntimeError('Diff failed!')
+        except RuntimeError as re:
+            pass
+
+        self.assertFalse(path.exists(self.bundle_path))
+
+    def test_bundles_can_be_written_with_any_tar_compression(self):
+        for compression, mode in [('gz', 'r:gz'), ('none', 'r:'), ('xz', 'r:xz')]:
+            bundle_path = path.join(self.temp_dir, 'bundle.%s' % compression)
+            file_path = self.create_file('file', b'content')
+
+            with self.test_class(bundle_path,
+                                 compression = compression) as test_object:
+                test_object.add(file_path, 'file')
+
+            with tarfile.open(bundle_path, mode) as archive_object:
+                self.assertEqual(b'content',
+                                 archive_object.extractfile('file').read())
+
+    def test_auto_compression_only_deflates_compressible_members(self):
+        text_path = self.create_file('text', b'compressible content ' * 1000)
+        random_path = self.create_file('random', urandom(100 * 1024))
+
+        with self.test_class(self.bundle_path,
+                             compression = 'auto') as test_object:
+            test_object.add(text_path, 'text')
+            test_object.add(random_path, 'random')
+
+        # The container itself is left uncompressed
+        with tarfile.open(self.bundle_path, 'r:') as archive_object:
+            text_member = archive_object.getmember('text')
+            self.assertEqual('zlib',
+                             text_member.pax_headers['XDELTA3.compression'])
+            self.assertEqual(str(21 * 1000),
+                             text_member.pax_headers['XDELTA3.size'])
+            self.assertLess(text_member.size, 21 * 1000)
+
+            random_member = archive_object.getmember('random')
+            self.assertNotIn('XDELTA3.compression', random_member.pax_headers)
+            self.assertEqual(100 * 1024, random_member.size)
+
+    def test_indexed_bundles_can_be_written(self):
+        file_path = self.create_file('file', b'content')
+
+        with self.test_class(self.bundle_path,
+                             bundle_format = 'indexed') as test_object:
+            test_object.add(file_path, 'file')
+
+        self.assertFalse(path.exists(file_path))
+
+        with self.patcher.XDelta3IndexedImpl(self.bundle_path) as archive_object:
+            output = BytesIO()
+            archive_object.copy_member('file', output)
+
+            self.assertEqual(b'content', output.getvalue())
+
+    def test_indexed_bundles_only_allow_per_member_compression(self):
+        with self.assertRaises(RuntimeError):
+            self.test_class(self.bundle_path, compression = 'gz',
+                            bundle_format = 'indexed')
+
+    @unittest.skipIf(patcher.zstandard is None, 'zstandard module is missing')
+    def test_zstd_bundles_can_be_read_back(self):
+        file_path = self.create_file('file', b'content')
+
+        with self.test_class(self.bundle_path,
+                             compression = 'zstd') as test_object:
+            test_object.add(file_path, 'file')
+
+        with self.patcher.XDelta3TarImpl(self.bundle_path) as archive_object:
+            output = BytesIO()
+            archive_object.copy_member('file', output)
+
+            self.assertEqual(b'content', output.getvalue())
+
+    def test_write_errors_are_raised_on_close(self):
+        test_object = self.test_class(self.bundle_path)
+        test_object.add(path.join(self.temp_dir, 'missing'), 'missing')
+
+        with self.assertRaises(OSError):
+            test_object.close()
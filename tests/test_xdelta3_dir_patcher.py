@@ -16,16 +16,21 @@
 #   Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301
 #   USA
 
+import ctypes
+import errno
 import imp
+import json
 import unittest
 import tarfile
+import time
 
 from filecmp import dircmp, cmpfiles
-from mock import Mock
+from io import BytesIO
+from mock import Mock, call
 from shutil import rmtree, copytree
 from subprocess import CalledProcessError, STDOUT
 from tempfile import mkdtemp
-from os import path, remove, walk, chmod
+from os import listdir, link, makedirs, path, remove, stat, utime, walk, chmod
 from stat import S_IRWXU, S_IRWXG, S_IROTH, S_IXOTH
 
 from .test_helpers import TestHelpers
@@ -337,6 +342,678 @@ class TestXDelta3DirPatcher(unittest.TestCase):
 
         TestHelpers.compare_trees(self, self.temp_dir, new_path)
 
+    def test_diff_works_without_staging(self):
+        old_path = path.join(self.TEST_FILE_PREFIX, 'old_version1')
+        old_bundle = path.join(self.TEST_FILE_PREFIX, 'old_version1.tgz')
+        new_path = path.join(self.TEST_FILE_PREFIX, 'new_version1')
+        new_bundle = path.join(self.TEST_FILE_PREFIX, 'new_version1.tgz')
+        generated_delta_path = path.join(self.temp_dir2, 'patch.xdelta')
+
+        TestHelpers.check_output2(["./%s" % self.EXECUTABLE,
+                                   "--debug",
+                                   "diff",
+                                   "--no-staging",
+                                   old_bundle,
+                                   new_bundle,
+                                   generated_delta_path])
+
+        TestHelpers.check_output2(["./%s" % self.EXECUTABLE,
+                                   "--debug",
+                                   "apply",
+                                   old_path,
+                                   generated_delta_path,
+                                   self.temp_dir,
+                                   "--ignore-euid"])
+
+        TestHelpers.compare_trees(self, self.temp_dir, new_path)
+
+    def test_diff_works_with_uncompressed_and_auto_bundles(self):
+        old_path = path.join(self.TEST_FILE_PREFIX, 'old_version1')
+        new_path = path.join(self.TEST_FILE_PREFIX, 'new_version1')
+
+        for compression in ['none', 'auto']:
+            generated_delta_path = path.join(self.temp_dir2,
+                                             'patch_%s.xdelta' % compression)
+            target_path = path.join(self.temp_dir2, 'target_%s' % compression)
+
+            TestHelpers.check_output2(["./%s" % self.EXECUTABLE,
+                                       "--debug",
+                                       "diff",
+                                       "--compression",
+                                       compression,
+                                       old_path,
+                                       new_path,
+                                       generated_delta_path])
+
+            TestHelpers.check_output2(["./%s" % self.EXECUTABLE,
+                                       "--debug",
+                                       "apply",
+                                       old_path,
+                                       generated_delta_path,
+                                       target_path,
+                                       "--ignore-euid"])
+
+            TestHelpers.compare_trees(self, target_path, new_path)
+
+    def test_diff_works_with_indexed_bundles(self):
+        old_path = path.join(self.TEST_FILE_PREFIX, 'old_version1')
+        new_path = path.join(self.TEST_FILE_PREFIX, 'new_version1')
+        generated_delta_path = path.join(self.temp_dir2, 'patch.xdelta')
+
+        TestHelpers.check_output2(["./%s" % self.EXECUTABLE,
+                                   "--debug",
+                                   "diff",
+                                   "--format",
+                                   "indexed",
+                                   "--compression",
+                                   "auto",
+                                   old_path,
+                                   new_path,
+                                   generated_delta_path])
+
+        TestHelpers.check_output2(["./%s" % self.EXECUTABLE,
+                                   "--debug",
+                                   "apply",
+                                   old_path,
+                                   generated_delta_path,
+                                   self.temp_dir,
+                                   "--ignore-euid"])
+
+        TestHelpers.compare_trees(self, self.temp_dir, new_path)
+
+    def test_diff_and_apply_work_with_worker_processes(self):
+        old_path = path.join(self.TEST_FILE_PREFIX, 'old_version1.tgz')
+        new_path = path.join(self.TEST_FILE_PREFIX, 'new_version1.tgz')
+        generated_delta_path = path.join(self.temp_dir2, 'patch.xdelta')
+
+        TestHelpers.check_output2(["./%s" % self.EXECUTABLE,
+                                   "--debug",
+                                   "--runner-mode",
+                                   "process",
+                                   "--jobs",
+                                   "2",
+                                   "diff",
+                                   old_path,
+                                   new_path,
+                                   generated_delta_path])
+
+        TestHelpers.check_output2(["./%s" % self.EXECUTABLE,
+                                   "--debug",
+                                   "--runner-mode",
+                                   "process",
+                                   "apply",
+                                   path.join(self.TEST_FILE_PREFIX, 'old_version1'),
+                                   generated_delta_path,
+                                   self.temp_dir,
+                                   "--ignore-euid"])
+
+        TestHelpers.compare_trees(self, self.temp_dir,
+                                  path.join(self.TEST_FILE_PREFIX, 'new_version1'))
+
+    def test_diff_works_with_unchanged_files_skipped(self):
+        old_path = path.join(self.TEST_FILE_PREFIX, 'old_version1')
+        new_path = path.join(self.temp_dir2, 'new_version')
+        generated_delta_path = path.join(self.temp_dir2, 'patch.xdelta')
+
+        # Only one changed file so that most of the tree is unchanged
+        copytree(old_path, new_path)
+        with open(path.join(new_path, 'short_lorem.txt'), 'a') as new_file:
+            new_file.write('extra content')
+        remove(path.join(new_path, 'deleted_file.txt'))
+
+        TestHelpers.check_output2(["./%s" % self.EXECUTABLE,
+                                   "--debug",
+                                   "diff",
+                                   "--skip-unchanged",
+                                   old_path,
+                                   new_path,
+                                   generated_delta_path])
+
+        with tarfile.open(generated_delta_path) as archive_file:
+            names = archive_file.getnames()
+
+        self.assertIn('xdelta/short_lorem.txt', names)
+        self.assertNotIn('xdelta/long_lorem.txt', names)
+        self.assertIn('.manifest', names)
+
+        TestHelpers.check_output2(["./%s" % self.EXECUTABLE,
+                                   "--debug",
+                                   "apply",
+                                   old_path,
+                                   generated_delta_path,
+                                   self.temp_dir,
+                                   "--ignore-euid"])
+
+        TestHelpers.compare_trees(self, self.temp_dir, new_path)
+
+    def test_largest_files_are_queued_first(self):
+        old_path = path.join(self.temp_dir2, 'old_version')
+        new_path = path.join(self.temp_dir2, 'new_version')
+        generated_delta_path = path.join(self.temp_dir2, 'patch.xdelta')
+
+        # Many files with the largest one listed last
+        makedirs(old_path)
+        makedirs(new_path)
+        names = ['file%03d' % index for index in range(300)] + ['zz_largest']
+        for index, name in enumerate(names):
+            for version_path in [old_path, new_path]:
+                with open(path.join(version_path, name), 'w') as version_file:
+                    version_file.write('%s %s\n' % (version_path, name) *
+                                       (index + 1) * 10)
+
+        output = TestHelpers.check_output2(["./%s" % self.EXECUTABLE,
+                                            "--debug",
+                                            "diff",
+                                            old_path,
+                                            new_path,
+                                            generated_delta_path])
+
+        queued = [line for line in output.splitlines()
+                  if line.startswith('Queueing ')]
+        self.assertEqual("Queueing 'zz_largest'", queued[0])
+
+        output = TestHelpers.check_output2(["./%s" % self.EXECUTABLE,
+                                            "--debug",
+                                            "--no-streaming",
+                                            "apply",
+                                            old_path,
+                                            generated_delta_path,
+                                            self.temp_dir,
+                                            "--ignore-euid"])
+
+        queued = [line for line in output.splitlines()
+                  if line.startswith('Queueing ')]
+        self.assertEqual("Queueing 'xdelta/zz_largest'", queued[0])
+
+        TestHelpers.compare_trees(self, self.temp_dir, new_path)
+
+    def test_diff_works_with_segmented_large_files(self):
+        old_path = path.join(self.temp_dir2, 'old_version')
+        new_path = path.join(self.temp_dir2, 'new_version')
+        generated_delta_path = path.join(self.temp_dir2, 'patch.xdelta')
+
+        copytree(path.join(self.TEST_FILE_PREFIX, 'old_version1'), old_path)
+        copytree(path.join(self.TEST_FILE_PREFIX, 'new_version1'), new_path)
+
+        # A bit over 2 segments with an insertion that shifts the rest
+        content = bytes(range(256)) * (9 * 1024)
+        with open(path.join(old_path, 'large_file.bin'), 'wb') as old_file:
+            old_file.write(content)
+        with open(path.join(new_path, 'large_file.bin'), 'wb') as new_file:
+            new_file.write(content[:1000000] + b'inserted' + content[1000000:])
+
+        TestHelpers.check_output2(["./%s" % self.EXECUTABLE,
+                                   "--debug",
+                                   "diff",
+                                   "--segment-size",
+                                   "1",
+                                   old_path,
+                                   new_path,
+                                   generated_delta_path])
+
+        with tarfile.open(generated_delta_path) as archive_file:
+            names = archive_file.getnames()
+
+        self.assertNotIn('xdelta/large_file.bin', names)
+        self.assertIn('.segments/large_file.bin/0', names)
+        self.assertIn('.segments/large_file.bin/2', names)
+        self.assertIn('.manifest', names)
+
+        TestHelpers.check_output2(["./%s" % self.EXECUTABLE,
+                                   "--debug",
+                                   "apply",
+                                   old_path,
+                                   generated_delta_path,
+                                   self.temp_dir,
+                                   "--ignore-euid"])
+
+        TestHelpers.compare_trees(self, self.temp_dir, new_path)
+
+    def test_diff_works_with_moved_files(self):
+        old_path = path.join(self.temp_dir2, 'old_version')
+        new_path = path.join(self.temp_dir2, 'new_version')
+        generated_delta_path = path.join(self.temp_dir2, 'patch.xdelta')
+
+        # A renamed folder with a changed file and a copy of a moved one
+        copytree(path.join(self.TEST_FILE_PREFIX, 'old_version1'), old_path)
+        copytree(old_path, new_path)
+        rmtree(path.join(new_path, 'updated folder'))
+        copytree(path.join(old_path, 'updated folder'),
+                 path.join(new_path, 'renamed folder'))
+        with open(path.join(new_path, 'renamed folder', 'updated file.txt'),
+                  'a') as new_file:
+            new_file.write('extra content')
+        with open(path.join(old_path, 'long_lorem.txt'), 'rb') as old_file, \
+             open(path.join(new_path, 'long_lorem copy.txt'), 'wb') as new_file:
+            new_file.write(old_file.read())
+
+        TestHelpers.check_output2(["./%s" % self.EXECUTABLE,
+                                   "--debug",
+                                   "diff",
+                                   "--detect-moves",
+                                   old_path,
+                                   new_path,
+                                   generated_delta_path])
+
+        with tarfile.open(generated_delta_path) as archive_file:
+            names = archive_file.getnames()
+
+        self.assertIn('xdelta/renamed folder/updated file.txt', names)
+        self.assertNotIn('xdelta/long_lorem copy.txt', names)
+        self.assertIn('.manifest', names)
+
+        # In place so that the moved sources are removed by the apply too
+        TestHelpers.check_output2(["./%s" % self.EXECUTABLE,
+                                   "--debug",
+                                   "apply",
+                                   old_path,
+                                   generated_delta_path,
+                                   "--ignore-euid"])
+
+        TestHelpers.compare_trees(self, old_path, new_path)
+
+    def test_diff_works_with_preserved_hardlinks(self):
+        old_path = path.join(self.temp_dir2, 'old_version')
+        new_path = path.join(self.temp_dir2, 'new_version')
+        generated_delta_path = path.join(self.temp_dir2, 'patch.xdelta')
+        target_path = path.join(self.temp_dir2, 'target')
+
+        copytree(path.join(self.TEST_FILE_PREFIX, 'old_version1'), old_path)
+        copytree(path.join(self.TEST_FILE_PREFIX, 'new_version1'), new_path)
+        link(path.join(new_path, 'long_lorem.txt'),
+             path.join(new_path, 'long_lorem_link.txt'))
+        link(path.join(new_path, 'long_lorem.txt'),
+             path.join(new_path, 'new folder', 'long_lorem_link.txt'))
+
+        TestHelpers.check_output2(["./%s" % self.EXECUTABLE,
+                                   "--debug",
+                                   "diff",
+                                   "--preserve-hardlinks",
+                                   old_path,
+                                   new_path,
+                                   generated_delta_path])
+
+        with tarfile.open(generated_delta_path) as archive_file:
+            names = archive_file.getnames()
+
+        self.assertNotIn('xdelta/long_lorem_link.txt', names)
+        self.assertNotIn('xdelta/new folder/long_lorem_link.txt', names)
+
+        TestHelpers.check_output2(["./%s" % self.EXECUTABLE,
+                                   "--debug",
+                                   "apply",
+                                   old_path,
+                                   generated_delta_path,
+                                   target_path,
+                                   "--ignore-euid"])
+
+        TestHelpers.compare_trees(self, new_path, target_path)
+
+        inode = stat(path.join(target_path, 'long_lorem.txt')).st_ino
+        for name in ['long_lorem_link.txt',
+                     path.join('new folder', 'long_lorem_link.txt')]:
+            self.assertEqual(stat(path.join(target_path, name)).st_ino, inode)
+
+    def test_diff_works_with_deduplicated_deltas(self):
+        old_path = path.join(self.temp_dir2, 'old_version')
+        new_path = path.join(self.temp_dir2, 'new_version')
+        generated_delta_path = path.join(self.temp_dir2, 'patch.xdelta')
+        target_path = path.join(self.temp_dir2, 'target')
+
+        # The same library vendored in several folders gets the same update
+        copytree(path.join(self.TEST_FILE_PREFIX, 'old_version1'), old_path)
+        for vendor in ['vendor1', 'vendor2', 'vendor3']:
+            copytree(path.join(self.TEST_FILE_PREFIX, 'old_version1',
+                               'updated folder'),
+                     path.join(old_path, vendor))
+
+        copytree(old_path, new_path)
+        for vendor in ['vendor1', 'vendor2', 'vendor3']:
+            with open(path.join(new_path, vendor, 'updated file.txt'),
+                      'a') as new_file:
+                new_file.write('extra content')
+
+        TestHelpers.check_output2(["./%s" % self.EXECUTABLE,
+                                   "--debug",
+                                   "diff",
+                                   "--dedup-deltas",
+                                   old_path,
+                                   new_path,
+                                   generated_delta_path])
+
+        with tarfile.open(generated_delta_path) as archive_file:
+            names = archive_file.getnames()
+            manifest = json.loads(archive_file.extractfile('.manifest')
+                                              .read().decode('utf-8'))
+
+        for vendor in ['vendor1', 'vendor2', 'vendor3']:
+            self.assertNotIn('xdelta/%s/updated file.txt' % vendor, names)
+
+        groups = {}
+        for name, entry in manifest['entries'].items():
+            if entry['type'] == 'blob':
+                groups.setdefault(entry['blob'], []).append(name)
+
+        # Copies of the updated folder share one delta per file
+        folders = ['updated folder', 'vendor1', 'vendor2', 'vendor3']
+        expected_groups = [
+            ['deleted_file.txt', 'long_lorem.txt'],
+            [path.join(folder, '.hidden_updated_file.txt') for folder in folders],
+            [path.join(folder, 'deleted_file_in_folder.txt') for folder in folders],
+            [path.join(folder, 'updated_folder', 'updated_file2.txt')
+             for folder in folders],
+            [path.join(folder, 'updated file.txt') for folder in folders[1:]] ]
+
+        self.assertEqual(sorted(expected_groups),
+                         sorted(sorted(group) for group in groups.values()))
+        self.assertEqual(sorted('.blobs/%s' % blob for blob in groups),
+                         sorted(name for name in names
+                                if name.startswith('.blobs/')))
+
+        TestHelpers.check_output2(["./%s" % self.EXECUTABLE,
+                                   "--debug",
+                                   "apply",
+                                   old_path,
+                                   generated_delta_path,
+                                   target_path,
+                                   "--ignore-euid"])
+
+        TestHelpers.compare_trees(self, new_path, target_path)
+
+    def test_apply_works_with_journal(self):
+        old_path = path.join(self.temp_dir2, 'old_version')
+        new_path = path.join(self.TEST_FILE_PREFIX, 'new_version1')
+        generated_delta_path = path.join(self.temp_dir2, 'patch.xdelta')
+
+        copytree(path.join(self.TEST_FILE_PREFIX, 'old_version1'), old_path)
+
+        TestHelpers.check_output2(["./%s" % self.EXECUTABLE,
+                                   "--debug",
+                                   "diff",
+                                   old_path,
+                                   new_path,
+                                   generated_delta_path])
+
+        TestHelpers.check_output2(["./%s" % self.EXECUTABLE,
+                                   "--debug",
+                                   "apply",
+                                   "--journal",
+                                   old_path,
+                                   generated_delta_path,
+                                   "--ignore-euid"])
+
+        TestHelpers.compare_trees(self, new_path, old_path)
+        self.assertFalse(path.exists(path.join(old_path, '.xdelta3-journal')))
+
+    def test_diff_reuses_deltas_of_the_work_dir(self):
+        old_path = path.join(self.TEST_FILE_PREFIX, 'old_version1')
+        new_path = path.join(self.TEST_FILE_PREFIX, 'new_version1')
+        work_dir = path.join(self.temp_dir2, 'work')
+
+        outputs = []
+        for bundle in ['patch1.xdelta', 'patch2.xdelta']:
+            outputs.append(TestHelpers.check_output2(["./%s" % self.EXECUTABLE,
+                                                      "--debug",
+                                                      "diff",
+                                                      "--work-dir",
+                                                      work_dir,
+                                                      old_path,
+                                                      new_path,
+                                                      path.join(self.temp_dir2,
+                                                                bundle)]))
+
+            if bundle == 'patch1.xdelta':
+                deltas = sorted(listdir(path.join(work_dir, 'deltas')))
+
+        self.assertNotEqual([], deltas)
+        self.assertEqual(deltas, sorted(listdir(path.join(work_dir, 'deltas'))))
+
+        # Every delta of the second run comes from the work folder
+        self.assertNotIn('Reusing delta of', outputs[0])
+        self.assertEqual(len(deltas), outputs[1].count('Reusing delta of'))
+
+        target_path = path.join(self.temp_dir2, 'target')
+        TestHelpers.check_output2(["./%s" % self.EXECUTABLE,
+                                   "--debug",
+                                   "apply",
+                                   old_path,
+                                   path.join(self.temp_dir2, 'patch2.xdelta'),
+                                   target_path,
+                                   "--ignore-euid"])
+
+        TestHelpers.compare_trees(self, new_path, target_path)
+
+    def test_diffs_sharing_a_work_dir_keep_each_others_deltas(self):
+        old_path = path.join(self.TEST_FILE_PREFIX, 'old_version1')
+        new_path = path.join(self.TEST_FILE_PREFIX, 'new_version1')
+        work_dir = path.join(self.temp_dir2, 'work')
+
+        def diff(old_version, new_version, *options):
+            return TestHelpers.check_output2(["./%s" % self.EXECUTABLE,
+                                              "--debug",
+                                              "diff",
+                                              "--work-dir",
+                                              work_dir] +
+                                             list(options) +
+                                             [old_version,
+                                              new_version,
+                                              path.join(self.temp_dir2,
+                                                        'patch.xdelta')])
+
+        diff(old_path, new_path)
+        forward_deltas = set(listdir(path.join(work_dir, 'deltas')))
+
+        diff(new_path, old_path)
+        self.assertTrue(forward_deltas < set(listdir(path.join(work_dir,
+                                                               'deltas'))))
+
+        self.assertEqual(len(forward_deltas),
+                         diff(old_path, new_path).count('Reusing delta of'))
+
+        # Only the deltas that weren't used lately are pruned
+        for name in listdir(path.join(work_dir, 'deltas')):
+            if name not in forward_deltas:
+                utime(path.join(work_dir, 'deltas', name), (0, 0))
+
+        diff(old_path, new_path, '--work-dir-max-age', '1')
+        self.assertEqual(forward_deltas,
+                         set(listdir(path.join(work_dir, 'deltas'))))
+
+    def test_diff_copies_deltas_from_the_delta_cache(self):
+        old_path = path.join(self.TEST_FILE_PREFIX, 'old_version1')
+        new_path = path.join(self.TEST_FILE_PREFIX, 'new_version1')
+        cache_path = path.join(self.temp_dir2, 'cache.xdelta')
+        generated_delta_path = path.join(self.temp_dir2, 'patch.xdelta')
+        target_path = path.join(self.temp_dir2, 'target')
+
+        TestHelpers.check_output2(["./%s" % self.EXECUTABLE,
+                                   "diff",
+                                   "--record-hashes",
+                                   old_path,
+                                   new_path,
+                                   cache_path])
+
+        output = TestHelpers.check_output2(["./%s" % self.EXECUTABLE,
+                                            "--debug",
+                                            "diff",
+                                            "--delta-cache",
+                                            cache_path,
+                                            old_path,
+                                            new_path,
+                                            generated_delta_path])
+
+        self.assertIn('Cached delta: long_lorem.txt', output)
+
+        # Payloads are copied verbatim
+        with tarfile.open(cache_path) as cache_file, \
+             tarfile.open(generated_delta_path) as archive_file:
+            member = 'xdelta/long_lorem.txt'
+            self.assertEqual(cache_file.extractfile(member).read(),
+                             archive_file.extractfile(member).read())
+
+        TestHelpers.check_output2(["./%s" % self.EXECUTABLE,
+                                   "apply",
+                                   old_path,
+                                   generated_delta_path,
+                                   target_path,
+                                   "--ignore-euid"])
+
+        TestHelpers.compare_trees(self, new_path, target_path)
+
+    def test_worker_processes_copy_deltas_from_the_delta_cache(self):
+        old_path = path.join(self.TEST_FILE_PREFIX, 'old_version1')
+        new_path = path.join(self.TEST_FILE_PREFIX, 'new_version1')
+        cache_path = path.join(self.temp_dir2, 'cache.xdelta')
+        generated_delta_path = path.join(self.temp_dir2, 'patch.xdelta')
+        target_path = path.join(self.temp_dir2, 'target')
+
+        TestHelpers.check_output2(["./%s" % self.EXECUTABLE,
+                                   "diff",
+                                   "--record-hashes",
+                                   old_path,
+                                   new_path,
+                                   cache_path])
+
+        output = TestHelpers.check_output2(["./%s" % self.EXECUTABLE,
+                                            "--debug",
+                                            "--runner-mode",
+                                            "process",
+                                            "diff",
+                                            "--delta-cache",
+                                            cache_path,
+                                            old_path,
+                                            new_path,
+                                            generated_delta_path])
+
+        self.assertIn('Cached delta: long_lorem.txt', output)
+
+        # The hashes are still recorded for later diffs
+        with tarfile.open(generated_delta_path) as archive_file:
+            manifest = json.loads(archive_file.extractfile('.manifest')
+                                              .read().decode('utf-8'))
+        self.assertIn('long_lorem.txt', manifest['hashes'])
+
+        TestHelpers.check_output2(["./%s" % self.EXECUTABLE,
+                                   "apply",
+                                   old_path,
+                                   generated_delta_path,
+                                   target_path,
+                                   "--ignore-euid"])
+
+        TestHelpers.compare_trees(self, new_path, target_path)
+
+    def test_apply_works_with_chained_bundles(self):
+        old_path = path.join(self.TEST_FILE_PREFIX, 'old_version1')
+        new_path = path.join(self.TEST_FILE_PREFIX, 'new_version1')
+        forward_path = path.join(self.temp_dir2, 'forward.xdelta')
+        backward_path = path.join(self.temp_dir2, 'backward.xdelta')
+        target_path = path.join(self.temp_dir2, 'target')
+
+        TestHelpers.check_output2(["./%s" % self.EXECUTABLE,
+                                   "diff",
+                                   old_path,
+                                   new_path,
+                                   forward_path])
+
+        TestHelpers.check_output2(["./%s" % self.EXECUTABLE,
+                                   "diff",
+                                   new_path,
+                                   old_path,
+                                   backward_path])
+
+        # The new version is never written out on the way back
+        TestHelpers.check_output2(["./%s" % self.EXECUTABLE,
+                                   "apply",
+                                   "--chain",
+                                   backward_path,
+                                   "--chain",
+                                   forward_path,
+                                   old_path,
+                                   forward_path,
+                                   target_path,
+                                   "--ignore-euid"])
+
+        TestHelpers.compare_trees(self, new_path, target_path)
+
+    def test_apply_verifies_the_old_version(self):
+        old_path = path.join(self.TEST_FILE_PREFIX, 'old_version1')
+        new_path = path.join(self.TEST_FILE_PREFIX, 'new_version1')
+        generated_delta_path = path.join(self.temp_dir2, 'patch.xdelta')
+        target_path = path.join(self.temp_dir2, 'target')
+
+        TestHelpers.check_output2(["./%s" % self.EXECUTABLE,
+                                   "diff",
+                                   "--record-base",
+                                   old_path,
+                                   new_path,
+                                   generated_delta_path])
+
+        # The wrong old version is rejected before anything is written
+        with self.assertRaises(CalledProcessError):
+            TestHelpers.check_output2(["./%s" % self.EXECUTABLE,
+                                       "apply",
+                                       "--verify",
+                                       "full",
+                                       new_path,
+                                       generated_delta_path,
+                                       target_path,
+                                       "--ignore-euid"])
+
+        self.assertFalse(path.exists(target_path))
+
+        TestHelpers.check_output2(["./%s" % self.EXECUTABLE,
+                                   "apply",
+                                   "--verify",
+                                   "full",
+                                   old_path,
+                                   generated_delta_path,
+                                   target_path,
+                                   "--ignore-euid"])
+
+        TestHelpers.compare_trees(self, new_path, target_path)
+
+    def test_journaled_apply_leaves_no_journal_on_a_rejected_old_version(self):
+        old_path = path.join(self.TEST_FILE_PREFIX, 'old_version1')
+        new_path = path.join(self.TEST_FILE_PREFIX, 'new_version1')
+        generated_delta_path = path.join(self.temp_dir2, 'patch.xdelta')
+        target_path = path.join(self.temp_dir2, 'target')
+
+        TestHelpers.check_output2(["./%s" % self.EXECUTABLE,
+                                   "diff",
+                                   "--record-base",
+                                   old_path,
+                                   new_path,
+                                   generated_delta_path])
+
+        copytree(old_path, target_path, symlinks = True)
+        tampered_path = path.join(target_path, 'long_lorem.txt')
+        original_content = TestHelpers.get_content(tampered_path)
+        with open(tampered_path, 'ab') as tampered_file:
+            tampered_file.write(b'tampered')
+
+        apply_command = ["./%s" % self.EXECUTABLE,
+                         "apply",
+                         "--journal",
+                         "--verify",
+                         "full",
+                         target_path,
+                         generated_delta_path,
+                         target_path,
+                         "--ignore-euid"]
+
+        with self.assertRaises(CalledProcessError):
+            TestHelpers.check_output2(apply_command)
+
+        self.assertNotIn('.xdelta3-journal', listdir(target_path))
+
+        # Once the old version is right, the same bundle applies
+        with open(tampered_path, 'wb') as tampered_file:
+            tampered_file.write(original_content)
+
+        TestHelpers.check_output2(apply_command)
+
+        TestHelpers.compare_trees(self, new_path, target_path)
+
     # Integration tests
     def test_version_is_correct(self):
         output = TestHelpers.check_output2(["./%s" % self.EXECUTABLE,
@@ -558,6 +1235,18 @@ class TestXDelta3DirPatcher(unittest.TestCase):
                 self.xdelta_test_class().diff(old_file, new_file, target_file,
                                               debug)
 
+            @staticmethod
+            def diff_stream(old_file, write_new, target_file, debug = False,
+                            options = None):
+                if old_file:
+                  self.assertTrue(old_file.startswith(staging_dir))
+
+                self.assertTrue(target_file.startswith(staging_dir))
+
+                self.xdelta_test_class().diff_stream(old_file, write_new,
+                                                     target_file, debug,
+                                                     options)
+
         args = self.patcher.AttributeDict()
         args.action = 'diff'
         args.debug = True
@@ -609,6 +1298,683 @@ class TestXDelta3DirPatcher(unittest.TestCase):
                                     deleted_path,
                                     True)
 
+    def test_removal_plan_groups_removed_subtrees_children_first(self):
+        old_paths = [None,
+                     'kept',
+                     'kept/removed_file',
+                     'kept/kept_file',
+                     'removed',
+                     'removed/sub',
+                     'removed/sub/file',
+                     'removed/file',
+                     'removed_file']
+        kept_paths = ['kept', 'kept/kept_file', 'new_file']
+
+        plan = self.patcher.RemovalPlan(old_paths, kept_paths)
+
+        self.assertEqual(6, len(plan))
+        self.assertIn('removed/sub', plan)
+        self.assertNotIn('kept', plan)
+
+        self.assertEqual(['', 'kept'], sorted(plan.groups.keys()))
+        self.assertEqual(['kept/removed_file'], plan.groups['kept'])
+
+        top_group = plan.groups['']
+        self.assertEqual(sorted(top_group),
+                         ['removed', 'removed/file', 'removed/sub',
+                          'removed/sub/file', 'removed_file'])
+        for removed_path in top_group:
+            parent = path.dirname(removed_path)
+            if parent:
+                self.assertLess(top_group.index(removed_path),
+                                top_group.index(parent))
+
+    def test_removal_plan_groups_can_be_removed_in_order(self):
+        old_path = path.join(self.TEST_FILE_PREFIX, 'nested_deletion')
+        rmtree(self.temp_dir)
+        copytree(old_path, self.temp_dir)
+
+        with self.patcher.XDeltaArchive(self.temp_dir) as archive_object:
+            old_paths = list(archive_object.list_items().keys())
+
+        plan = self.patcher.RemovalPlan(old_paths, [])
+        for removed_items in plan.groups.values():
+            self.test_class.remove_items(self.temp_dir, removed_items, True)
+
+        self.assertEqual([], listdir(self.temp_dir))
+
+    def test_removal_plan_defers_groups_with_needed_paths(self):
+        plan = self.patcher.RemovalPlan(['a', 'a/b', 'a/b/c.txt', 'd.txt',
+                                         'e/f.txt', 'e'],
+                                        ['e'])
+
+        groups, deferred_groups = plan.split_groups(['a/b/c.txt'])
+
+        self.assertEqual([['e/f.txt']], groups)
+        self.assertEqual([['a/b/c.txt', 'a/b', 'a', 'd.txt']], deferred_groups)
+
+        groups, deferred_groups = plan.split_groups([])
+        self.assertEqual([], deferred_groups)
+
+    def test_move_detector_finds_copies_and_renamed_versions(self):
+        old_path = path.join(self.temp_dir2, 'old')
+        new_path = path.join(self.temp_dir2, 'new')
+        for folder in [path.join(old_path, 'foo-1.2'),
+                       path.join(new_path, 'foo-1.3')]:
+            makedirs(folder)
+
+        for tree, folder in [(old_path, 'foo-1.2'), (new_path, 'foo-1.3')]:
+            with open(path.join(tree, folder, 'x.so'), 'w') as x_file:
+                x_file.write('same content')
+            with open(path.join(tree, folder, 'y.so'), 'w') as y_file:
+                y_file.write('version %s' % folder)
+
+        with self.patcher.XDeltaArchive(old_path) as old_archive, \
+             self.patcher.XDeltaArchive(new_path) as new_archive:
+            test_object = self.patcher.MoveDetector(old_archive)
+
+            self.assertEqual('foo-1.2/x.so',
+                             test_object.find_copy(new_archive, 'foo-1.3/x.so'))
+            self.assertIsNone(test_object.find_copy(new_archive, 'foo-1.3/y.so'))
+
+            self.assertEqual('foo-1.2/y.so',
+                             test_object.find_similar(new_archive, 'foo-1.3/y.so'))
+            self.assertIsNone(test_object.find_similar(new_archive, 'foo-1.3'))
+
+    def test_move_detector_hashes_old_files_once(self):
+        old_archive = Mock()
+        old_archive.list_items.return_value = {
+            'a.txt': self.patcher.FileEntry('a.txt', None, 0o644, None, None,
+                                            None, None, False, size = 4),
+            'b.txt': self.patcher.FileEntry('b.txt', None, 0o644, None, None,
+                                            None, None, False, size = 4) }
+        old_archive.hash_member.side_effect = lambda name: 'hash of %s' % name
+
+        new_archive = Mock()
+        new_archive.member_size.return_value = 4
+        new_archive.hash_member.side_effect = \
+            lambda name, local_copy: 'hash of %s' % name
+
+        test_object = self.patcher.MoveDetector(old_archive)
+        for name in ['a.txt', 'b.txt', 'c.txt', 'a.txt', 'b.txt', 'c.txt']:
+            expected = name if name != 'c.txt' else None
+            self.assertEqual(expected, test_object.find_copy(new_archive, name))
+
+        self.assertEqual(sorted(['a.txt', 'b.txt']),
+                         sorted(call[0][0] for call in
+                                old_archive.hash_member.call_args_list))
+
+    def test_move_detector_hashes_candidates_up_front(self):
+        def entry(name, size):
+            return self.patcher.FileEntry(name, None, 0o644, None, None,
+                                          None, None, False, size = size)
+
+        old_archive = Mock()
+        old_archive.list_items.return_value = { 'a.txt': entry('a.txt', 4),
+                                                'b.txt': entry('b.txt', 4),
+                                                'c.txt': entry('c.txt', 8),
+                                                'kept.txt': entry('kept.txt', 4) }
+        old_archive.hash_member.side_effect = lambda name: 'hash of %s' % name
+
+        new_items = { 'b copy.txt': entry('b copy.txt', 4),
+                      'other.txt': entry('other.txt', 5),
+                      'kept.txt': entry('kept.txt', 4) }
+        new_archive = Mock()
+        new_archive.list_items.return_value = new_items
+        new_archive.member_size.side_effect = lambda name: new_items[name].size
+        new_archive.hash_member.side_effect = lambda name: 'hash of b.txt'
+
+        test_object = self.patcher.MoveDetector(old_archive)
+        test_object.hash_candidates(new_archive, sorted(new_items), True,
+                                    jobs = 2)
+
+        # Only the old files that a new file can be a copy of are read
+        self.assertEqual(['a.txt', 'b.txt', 'kept.txt'],
+                         sorted(call[0][0] for call in
+                                old_archive.hash_member.call_args_list))
+        self.assertEqual([call('b copy.txt')],
+                         new_archive.hash_member.call_args_list)
+
+        old_archive.hash_member.reset_mock()
+        new_archive.hash_member.reset_mock()
+
+        self.assertEqual('b.txt', test_object.find_copy(new_archive,
+                                                        'b copy.txt'))
+        self.assertIsNone(test_object.find_copy(new_archive, 'other.txt'))
+        self.assertFalse(old_archive.hash_member.called)
+        self.assertFalse(new_archive.hash_member.called)
+
+    def test_sketches_estimate_the_similarity_of_files(self):
+        lines = [('line %d of the resource\n' % index).encode('utf-8')
+                 for index in range(1000)]
+        changed_lines = list(lines)
+        for index in range(0, 1000, 20):
+            changed_lines[index] = b'changed\n'
+
+        sketch = self.patcher.sketch_stream(BytesIO(b''.join(lines)))
+        changed_sketch = self.patcher.sketch_stream(BytesIO(b''.join(changed_lines)))
+        other_sketch = self.patcher.sketch_stream(BytesIO(b'unrelated\n' * 1000))
+
+        self.assertEqual(self.patcher.SKETCH_SIZE, len(sketch))
+        self.assertEqual(1.0, self.patcher.sketch_similarity(sketch, sketch))
+        self.assertGreater(self.patcher.sketch_similarity(sketch, changed_sketch),
+                           0.8)
+        self.assertEqual(0, self.patcher.sketch_similarity(sketch, other_sketch))
+
+    def test_similarity_index_picks_the_closest_old_file(self):
+        old_path = path.join(self.temp_dir2, 'old')
+        new_path = path.join(self.temp_dir2, 'new')
+        makedirs(old_path)
+        makedirs(new_path)
+
+        lines = ['string %d\n' % index for index in range(500)]
+        with open(path.join(old_path, 'strings.de'), 'w') as old_file:
+            old_file.write(''.join(lines))
+        with open(path.join(old_path, 'other.txt'), 'w') as old_file:
+            old_file.write('something else\n' * 100)
+        with open(path.join(new_path, 'strings.fr'), 'w') as new_file:
+            new_file.write(''.join(lines[:450]) + 'chaine\n' * 50)
+
+        with self.patcher.XDeltaArchive(old_path) as old_archive, \
+             self.patcher.XDeltaArchive(new_path) as new_archive:
+            test_object = self.patcher.SimilarityIndex(old_archive, 60)
+            self.assertEqual('strings.de',
+                             test_object.find_similar(new_archive, 'strings.fr'))
+
+            # Nothing gets looked up once the budget is spent
+            test_object = self.patcher.SimilarityIndex(old_archive, 0)
+            self.assertIsNone(test_object.find_similar(new_archive, 'strings.fr'))
+
+    def test_plan_removal_lists_removals_without_applying(self):
+        old_path = path.join(self.TEST_FILE_PREFIX, 'nested_deletion')
+        patch_bundle = path.join(self.temp_dir2, 'patch.tgz')
+
+        # Payloads are never read so empty files are enough
+        payload_dir = path.join(self.temp_dir, 'updated folder')
+        makedirs(payload_dir)
+        open(path.join(payload_dir, 'updated file.txt'), 'w').close()
+
+        with self.patcher.XDelta3BundleWriter(patch_bundle) as bundle_writer:
+            bundle_writer.add(self.temp_dir, 'xdelta')
+            bundle_writer.add(payload_dir, 'xdelta/updated folder')
+            bundle_writer.add(path.join(payload_dir, 'updated file.txt'),
+                              'xdelta/updated folder/updated file.txt')
+
+        args = self.patcher.AttributeDict()
+        plan = self.test_class(args).plan_removal(old_path, patch_bundle)
+
+        self.assertEqual(['deleted_file_in_root.txt'], list(plan))
+        self.assertTrue(path.isfile(path.join(old_path,
+                                              'deleted_file_in_root.txt')))
+
+    def test_apply_journal_resumes_logged_paths(self):
+        bundle_id = { 'path': 'patch.tgz', 'size': 1 }
+
+        journal = self.patcher.ApplyJournal(self.temp_dir, bundle_id)
+        self.assertFalse(journal.resumed)
+
+        journal.mark_done('foo/bar.txt')
+        journal.close()
+
+        # Records torn by a crash are dropped
+        with open(journal.log_path, 'a') as log_file:
+            log_file.write('{"done": "ba')
+
+        journal = self.patcher.ApplyJournal(self.temp_dir, bundle_id)
+        self.assertTrue(journal.resumed)
+        self.assertTrue(journal.is_done('foo/bar.txt'))
+        self.assertFalse(journal.is_done('baz.txt'))
+        self.assertFalse(journal.committing)
+
+        journal.start_commit()
+        journal.close()
+
+        journal = self.patcher.ApplyJournal(self.temp_dir, bundle_id)
+        self.assertTrue(journal.committing)
+        self.assertTrue(journal.is_done('baz.txt'))
+        journal.close()
+
+        self.assertRaises(RuntimeError, self.patcher.ApplyJournal,
+                          self.temp_dir, { 'path': 'other.tgz', 'size': 1 })
+
+    def test_commit_journal_moves_files_into_place(self):
+        target_dir = self.temp_dir
+        for name, content in [('kept.txt', 'old'), ('deleted.txt', 'old')]:
+            with open(path.join(target_dir, name), 'w') as target_file:
+                target_file.write(content)
+
+        journal = self.patcher.ApplyJournal(target_dir, { 'path': 'patch.tgz' })
+        makedirs(path.join(journal.files_dir, 'new folder'))
+        for name in ['kept.txt', path.join('new folder', 'new file.txt')]:
+            with open(path.join(journal.files_dir, name), 'w') as shadow_file:
+                shadow_file.write('new')
+        journal.mark_done('kept.txt', 'new folder',
+                          path.join('new folder', 'new file.txt'))
+
+        args = self.patcher.AttributeDict()
+        self.test_class(args)._commit_journal(journal, target_dir,
+                                              [['deleted.txt']])
+
+        self.assertEqual(sorted(['kept.txt', 'new folder']),
+                         sorted(listdir(target_dir)))
+        for name in ['kept.txt', path.join('new folder', 'new file.txt')]:
+            self.assertEqual(b'new',
+                             TestHelpers.get_content(path.join(target_dir, name)))
+
+    def test_diff_checkpoint_stores_and_prunes_deltas(self):
+        checkpoint = self.patcher.DiffCheckpoint(self.temp_dir)
+        key = checkpoint.key('old hash', 'new hash', ['-9'])
+
+        self.assertNotEqual(key, checkpoint.key('old hash', 'new hash'))
+        self.assertNotEqual(key, checkpoint.key(None, 'new hash', ['-9']))
+        self.assertIsNone(checkpoint.lookup(key))
+
+        delta_path = path.join(self.temp_dir2, 'delta')
+        with open(delta_path, 'wb') as delta_file:
+            delta_file.write(b'delta content')
+
+        checkpoint.store(key, delta_path)
+        self.assertEqual(b'delta content',
+                         TestHelpers.get_content(checkpoint.lookup(key)))
+        self.assertEqual([key], listdir(checkpoint.deltas_dir))
+
+        # Deltas that weren't used within max_age are removed
+        checkpoint.prune(60)
+        self.assertIsNotNone(checkpoint.lookup(key))
+
+        last_use = time.time() - 2 * 60 * 60
+        utime(path.join(checkpoint.deltas_dir, key), (last_use, last_use))
+        checkpoint.prune(60 * 60)
+        self.assertIsNone(checkpoint.lookup(key))
+
+    def test_delta_cache_indexes_deltas_by_content_hashes(self):
+        manifest = self.patcher.PatchManifest()
+        manifest.set_hashes('foo/bar.txt', 'old', 'new')
+        manifest.set_options('foo/bar.txt', ['-B', '1024'])
+        manifest.set_hashes('shared.txt', None, 'shared')
+        manifest.add_entry('shared.txt', 'blob', blob = 'abc')
+        manifest.set_hashes('missing.txt', 'old', 'other')
+
+        archive_object = Mock()
+        archive_object.list_items.return_value = { 'xdelta/foo/bar.txt': None,
+                                                   '.blobs/abc': None }
+
+        delta_cache = self.patcher.DeltaCache()
+        self.assertEqual(2, delta_cache.add(archive_object, manifest,
+                                            'xdelta', '.blobs'))
+
+        self.assertEqual((archive_object, 'xdelta/foo/bar.txt', ['-B', '1024']),
+                         delta_cache.lookup('old', 'new'))
+        self.assertEqual((archive_object, '.blobs/abc', None),
+                         delta_cache.lookup(None, 'shared'))
+        self.assertIsNone(delta_cache.lookup('old', 'other'))
+        self.assertIsNone(delta_cache.lookup('new', 'old'))
+
+        delta_cache.close()
+        archive_object.close.assert_called_once_with()
+
+    def test_copy_attributes_from_item_restores_zero_mtime_and_owner(self):
+        target_path = path.join(self.temp_dir, 'target')
+        with open(target_path, 'w') as target_file:
+            target_file.write('content')
+
+        item = self.patcher.FileEntry('target', None, 0o600, None, 1234,
+                                      None, 1234, False, mtime = 0)
+
+        original_lchown = self.patcher.lchown
+        self.patcher.lchown = Mock(side_effect = PermissionError())
+        try:
+            args = self.patcher.AttributeDict({ 'ignore_euid': True })
+            self.test_class(args).copy_attributes_from_item(item, target_path)
+
+            self.assertEqual(0, stat(target_path).st_mtime)
+            self.assertEqual(0o600, stat(target_path).st_mode & 0o777)
+
+            args = self.patcher.AttributeDict()
+            self.assertRaises(PermissionError,
+                              self.test_class(args).copy_attributes_from_item,
+                              item, target_path)
+        finally:
+            self.patcher.lchown = original_lchown
+
+    def test_patch_chain_resolves_paths_through_all_bundles(self):
+        def file_item(name):
+            return self.patcher.FileEntry(name, None, 0o644, None, None, None,
+                                          None, False)
+
+        chain = self.patcher.PatchChain()
+        chain.add_bundle({ 'xdelta/a.txt': file_item('xdelta/a.txt') },
+                         { 'a.txt': 'xdelta/a.txt' },
+                         { 'b.txt': { 'type': 'unchanged' },
+                           'c.txt': { 'type': 'copy', 'source': 'gone.txt' } },
+                         { 'a.txt': ['-B', '1024'] },
+                         {})
+        chain.add_bundle({ 'xdelta/a.txt': file_item('xdelta/a.txt'),
+                           'xdelta/d.txt': file_item('xdelta/d.txt') },
+                         { 'a.txt': 'xdelta/a.txt', 'd.txt': 'xdelta/d.txt' },
+                         { 'b.txt': { 'type': 'hardlink', 'target': 'a.txt' } },
+                         {},
+                         { 'd.txt': 'c.txt' })
+
+        self.assertEqual(set(['a.txt', 'b.txt', 'd.txt']), chain.paths())
+
+        node = chain.resolve('a.txt')
+        self.assertEqual(('delta', 1, 'xdelta/a.txt', None),
+                         (node.kind, node.bundle, node.member, node.options))
+        self.assertEqual(('delta', 0, ['-B', '1024']),
+                         (node.source.kind, node.source.bundle,
+                          node.source.options))
+        self.assertEqual(['a.txt'], list(node.old_paths()))
+
+        # Hardlinks stand for their target
+        self.assertIs(node, chain.resolve('b.txt'))
+
+        # Moved files are decoded on top of their source's chain
+        node = chain.resolve('d.txt')
+        self.assertEqual('copy', node.source.kind)
+        self.assertEqual(['gone.txt'], list(node.old_paths()))
+
+        self.assertIsNone(chain.resolve('c.txt'))
+        self.assertIsNone(chain.resolve('gone.txt', 1))
+
+    def test_verify_base_rejects_changed_old_files(self):
+        old_dir = self.temp_dir
+        with open(path.join(old_dir, 'foo.txt'), 'w') as old_file:
+            old_file.write('old content')
+
+        manifest = self.patcher.PatchManifest()
+        manifest.set_base('foo.txt',
+                          self.patcher.hash_file(path.join(old_dir, 'foo.txt')),
+                          11,
+                          int(stat(path.join(old_dir, 'foo.txt')).st_mtime))
+
+        manifest_path = path.join(self.temp_dir2, 'manifest')
+        manifest.save(manifest_path)
+        base = self.patcher.PatchManifest.load(manifest_path).base_under()
+
+        args = self.patcher.AttributeDict({ 'verify': 'full' })
+        self.test_class(args).verify_base(old_dir, base)
+
+        # Same size and mtime but different content
+        mtime = stat(path.join(old_dir, 'foo.txt')).st_mtime
+        with open(path.join(old_dir, 'foo.txt'), 'w') as old_file:
+            old_file.write('new content')
+        utime(path.join(old_dir, 'foo.txt'), (mtime, mtime))
+
+        self.assertRaises(RuntimeError,
+                          self.test_class(args).verify_base, old_dir, base)
+
+        args = self.patcher.AttributeDict({ 'verify': 'mtime' })
+        self.test_class(args).verify_base(old_dir, base)
+
+        remove(path.join(old_dir, 'foo.txt'))
+        self.assertRaises(RuntimeError,
+                          self.test_class(args).verify_base, old_dir, base)
+
+        # Bundles without records can't be verified
+        self.assertRaises(RuntimeError,
+                          self.test_class(args).verify_base, old_dir, {})
+
+    def test_apply_chain_reads_each_bundle_in_archive_order(self):
+        old_dir = path.join(self.temp_dir, 'old')
+        target_dir = path.join(self.temp_dir, 'target')
+        makedirs(old_dir)
+
+        names = ['%s.txt' % letter for letter in 'abcdef']
+        for name in names:
+            with open(path.join(old_dir, name), 'w') as old_file:
+                old_file.write('old')
+
+        # Members are stored in the reverse order of their paths
+        bundles = []
+        for version in [1, 2]:
+            bundle_path = path.join(self.temp_dir2, 'bundle%d.tgz' % version)
+            with tarfile.open(bundle_path, 'w:gz') as bundle_file:
+                folder_info = tarfile.TarInfo('xdelta')
+                folder_info.type = tarfile.DIRTYPE
+                folder_info.mode = 0o755
+                bundle_file.addfile(folder_info)
+
+                for name in reversed(names):
+                    content = ('%s v%d' % (name, version)).encode('utf-8')
+                    member_info = tarfile.TarInfo('xdelta/%s' % name)
+                    member_info.size = len(content)
+                    member_info.mode = 0o644
+                    bundle_file.addfile(member_info, BytesIO(content))
+
+            bundles.append(bundle_path)
+
+        # Payloads hold the new content as is
+        class CopyDeltaImpl(object):
+            @staticmethod
+            def apply(old_file, patch_file, target_file, debug = False,
+                      **options):
+                with open(patch_file, 'rb') as patch, \
+                     open(target_file, 'wb') as target:
+                    target.write(patch.read())
+
+        offsets = {}
+        tar_class = self.patcher.XDelta3TarImpl
+        original_expand = tar_class.expand
+        def expand(archive_object, root, extraction_path):
+            member = archive_object.members[root].data
+            if member.isfile():
+                offsets.setdefault(id(archive_object), []).append(member.offset)
+
+            return original_expand(archive_object, root, extraction_path)
+
+        tar_class.expand = expand
+        self.addCleanup(setattr, tar_class, 'expand', original_expand)
+
+        args = self.patcher.AttributeDict({ 'ignore_euid': True, 'jobs': 2 })
+        self.test_class(args, delta_impl = CopyDeltaImpl).apply_chain(
+            old_dir, bundles, target_dir, staging_dir = self.temp_dir2)
+
+        for name in names:
+            self.assertEqual(('%s v2' % name).encode('utf-8'),
+                             TestHelpers.get_content(path.join(target_dir, name)))
+
+        # Each bundle is read once without seeking backwards
+        self.assertEqual(2, len(offsets))
+        for archive_offsets in offsets.values():
+            self.assertEqual(len(names), len(archive_offsets))
+            self.assertEqual(sorted(archive_offsets), archive_offsets)
+
+    def test_patch_manifest_can_be_saved_and_loaded(self):
+        manifest = self.patcher.PatchManifest()
+        manifest.add_unchanged('foo/bar.txt')
+        manifest.add_unchanged('baz.txt')
+
+        manifest_path = path.join(self.temp_dir, 'manifest')
+        manifest.save(manifest_path)
+
+        loaded_manifest = self.patcher.PatchManifest.load(manifest_path)
+
+        self.assertEqual(2, len(loaded_manifest))
+        self.assertEqual(manifest.entries, loaded_manifest.entries)
+        self.assertEqual('unchanged',
+                         loaded_manifest.entries['baz.txt']['type'])
+
+    def test_patch_manifest_entries_under_strips_root(self):
+        manifest = self.patcher.PatchManifest()
+        manifest.add_unchanged('inner_dir/foo/bar.txt')
+        manifest.add_unchanged('inner_dir_2/bar.txt')
+        manifest.add_unchanged('baz.txt')
+
+        self.assertEqual(['foo/bar.txt'],
+                         list(manifest.entries_under('inner_dir').keys()))
+        self.assertEqual(3, len(manifest.entries_under(None)))
+
+    def test_file_segments_cover_the_file_with_neighbouring_sources(self):
+        segments = self.patcher.FileSegments(2500, 1000, 200)
+
+        self.assertEqual(3, len(segments))
+        self.assertEqual([(0, 1000), (1000, 1000), (2000, 500)],
+                         [segments.new_range(index) for index in range(3)])
+
+        # Source regions are clipped by the size of the old file
+        self.assertEqual((0, 1200), segments.old_range(0, 3000))
+        self.assertEqual((800, 1400), segments.old_range(1, 3000))
+        self.assertEqual((1800, 200), segments.old_range(2, 2000))
+        self.assertEqual(0, segments.old_range(2, 0)[1])
+
+        loaded = self.patcher.FileSegments.from_entry(segments.to_entry())
+        self.assertEqual(segments.to_entry(), loaded.to_entry())
+
+    def test_file_segments_of_empty_files(self):
+        segments = self.patcher.FileSegments(0, 1000)
+
+        self.assertEqual(1, len(segments))
+        self.assertEqual((0, 0), segments.new_range(0))
+        self.assertEqual(1000, segments.window)
+
+    def test_segments_get_a_source_window_covering_their_old_region(self):
+        old_dir = path.join(self.temp_dir, 'old')
+        new_dir = path.join(self.temp_dir, 'new')
+        megabyte = 1024 * 1024
+
+        # Sparse files so that nothing gets written
+        for folder in [old_dir, new_dir]:
+            makedirs(folder)
+            with open(path.join(folder, 'big.img'), 'wb') as big_file:
+                big_file.truncate(70 * megabyte)
+
+        args = self.patcher.AttributeDict({ 'segment_size': 30 * megabyte })
+        test_object = self.test_class(args)
+        manifest = self.patcher.PatchManifest()
+        scheduler = Mock()
+
+        test_object._queue_segments(scheduler, 'big.img',
+                                    self.patcher.XDelta3FsImpl(old_dir),
+                                    self.patcher.XDelta3FsImpl(new_dir),
+                                    self.temp_dir2,
+                                    self.temp_dir2,
+                                    self.temp_dir2,
+                                    manifest,
+                                    False,
+                                    False,
+                                    Mock())
+
+        # The middle segment reads the whole old file
+        expected = ['-B', str(70 * megabyte)]
+        self.assertEqual(expected, manifest.options['big.img'])
+        self.assertEqual(3, scheduler.add_task.call_count)
+        for task_call in scheduler.add_task.call_args_list:
+            self.assertEqual(expected, task_call[0][2][6])
+
+    def test_find_file_delta_hashes_each_file_once(self):
+        old_dir = path.join(self.temp_dir, 'old')
+        new_dir = path.join(self.temp_dir, 'new')
+        for folder, content in [(old_dir, 'old content'),
+                                (new_dir, 'new content')]:
+            makedirs(folder)
+            with open(path.join(folder, 'file'), 'w') as version_file:
+                version_file.write(content)
+
+        old_archive = self.patcher.XDelta3FsImpl(old_dir)
+        new_archive = self.patcher.XDelta3FsImpl(new_dir)
+        old_archive.hash_member = Mock(side_effect = old_archive.hash_member)
+        new_archive.hash_member = Mock(side_effect = new_archive.hash_member)
+
+        target_root = path.join(self.temp_dir2, 'target')
+
+        test_object = self.test_class(self.patcher.AttributeDict())
+        target_path, hashes, decode_options = \
+            test_object._find_file_delta('file', old_archive, new_archive,
+                                         path.join(self.temp_dir2, 'old'),
+                                         path.join(self.temp_dir2, 'new'),
+                                         target_root,
+                                         True,
+                                         checkpoint = self.patcher.DiffCheckpoint(
+                                             path.join(self.temp_dir, 'work')),
+                                         delta_cache = self.patcher.DeltaCache(),
+                                         record_hashes = True)
+
+        self.assertEqual(path.join(target_root, 'file'), target_path)
+        self.assertEqual(1, old_archive.hash_member.call_count)
+        self.assertEqual(1, new_archive.hash_member.call_count)
+        self.assertEqual((self.patcher.XDelta3FsImpl(old_dir).hash_member('file'),
+                          self.patcher.XDelta3FsImpl(new_dir).hash_member('file')),
+                         hashes)
+        self.assertEqual([], decode_options)
+
+    def test_xdelta_impl_widens_the_source_window(self):
+        megabyte = 1024 * 1024
+        with_source_window = self.xdelta_test_class.with_source_window
+
+        self.assertEqual([], with_source_window(None, 64 * megabyte))
+        self.assertEqual(['-9', '-B', str(65 * megabyte)],
+                         with_source_window(['-9'], 65 * megabyte))
+        self.assertEqual(['-B', str(70 * megabyte)],
+                         with_source_window(['-B', '1024'], 70 * megabyte))
+        self.assertEqual(['-B', str(1024 * megabyte)],
+                         with_source_window(['-B', str(1024 * megabyte)],
+                                            70 * megabyte))
+
+    def test_sizes_in_megabytes_are_parsed_into_bytes(self):
+        self.assertEqual(3 * 1024 * 1024, self.patcher.megabytes('3'))
+
+    def test_patch_manifest_records_decoder_options(self):
+        manifest = self.patcher.PatchManifest()
+        manifest_path = path.join(self.temp_dir, 'manifest')
+
+        # Plain manifests stay readable by older patchers
+        manifest.add_unchanged('baz.txt')
+        manifest.save(manifest_path)
+        with open(manifest_path) as manifest_file:
+            self.assertEqual(1, json.load(manifest_file)['version'])
+
+        manifest.set_options('inner_dir/big.img', ['-B', '1024'])
+        manifest.save(manifest_path)
+
+        loaded_manifest = self.patcher.PatchManifest.load(manifest_path)
+        self.assertEqual({ 'big.img': ['-B', '1024'] },
+                         loaded_manifest.options_under('inner_dir'))
+        with open(manifest_path) as manifest_file:
+            self.assertEqual(2, json.load(manifest_file)['version'])
+
+    def test_tuning_rules_pick_the_first_matching_profile(self):
+        rules = self.patcher.TuningRules(['*.jpg=compressed',
+                                          'docs/*=text',
+                                          '>1=large'])
+
+        self.assertEqual('compressed', rules.profile_for('media/a.jpg', 10))
+        self.assertEqual('compressed', rules.profile_for('a.jpg', 10 * 1024 * 1024))
+        self.assertEqual('text', rules.profile_for('docs/readme', 10))
+        self.assertEqual('large', rules.profile_for('disk.img', 2 * 1024 * 1024))
+        self.assertEqual('default', rules.profile_for('disk.img', 1024 * 1024))
+
+        self.assertEqual(['-0', '-S', 'none'],
+                         rules.options_for('a.jpg', 10))
+
+    def test_tuning_rules_reject_unknown_profiles_and_sizes(self):
+        for rule in ['*.jpg', '*.jpg=unknown', '>abc=large', '=text']:
+            with self.assertRaises(ValueError):
+                self.patcher.TuningRules([rule])
+
+    def test_is_unchanged_detects_identical_files(self):
+        old_path = path.join(self.TEST_FILE_PREFIX, 'old_version1')
+        new_path = path.join(self.temp_dir, 'new_version')
+
+        copytree(old_path, new_path)
+        with open(path.join(new_path, 'short_lorem.txt'), 'a') as new_file:
+            new_file.write('extra content')
+
+        args = self.patcher.AttributeDict()
+        test_object = self.test_class(args)
+
+        with self.patcher.XDeltaArchive(old_path) as old_archive, \
+             self.patcher.XDeltaArchive(new_path) as new_archive:
+            self.assertTrue(test_object._is_unchanged('long_lorem.txt',
+                                                      old_archive,
+                                                      new_archive))
+            self.assertFalse(test_object._is_unchanged('short_lorem.txt',
+                                                       old_archive,
+                                                       new_archive))
+            self.assertFalse(test_object._is_unchanged('updated folder',
+                                                       old_archive,
+                                                       new_archive))
+
     # ------------------- XDeltaImpl tests
     def test_xdelta_impl_run_command_invokes_the_command(self):
         # TODO: implement the test
@@ -631,6 +1997,46 @@ class TestXDelta3DirPatcher(unittest.TestCase):
 
         self.xdelta_test_class.run_command = original_run_command
 
+    def test_xdelta_impl_diff_and_apply_pass_tuning_options(self):
+        original_run_command = self.xdelta_test_class.run_command
+        self.xdelta_test_class.run_command = Mock()
+
+        try:
+            self.xdelta_test_class.diff("old", "new", "target",
+                                        options = ['-B', '1024', '-9'])
+            self.xdelta_test_class.run_command \
+                                  .assert_called_once_with(['xdelta3',
+                                                            '-f',
+                                                            '-e',
+                                                            '-B',
+                                                            '1024',
+                                                            '-9',
+                                                            '-s',
+                                                            'old',
+                                                            'new',
+                                                            'target'])
+
+            decode_options = self.xdelta_test_class.decode_options(['-B',
+                                                                    '1024',
+                                                                    '-9'])
+            self.assertEqual(['-B', '1024'], decode_options)
+
+            self.xdelta_test_class.run_command.reset_mock()
+            self.xdelta_test_class.apply("old", "patch", "target",
+                                         options = decode_options)
+            self.xdelta_test_class.run_command \
+                                  .assert_called_once_with(['xdelta3',
+                                                            '-f',
+                                                            '-d',
+                                                            '-B',
+                                                            '1024',
+                                                            '-s',
+                                                            'old',
+                                                            'patch',
+                                                            'target'])
+        finally:
+            self.xdelta_test_class.run_command = original_run_command
+
     def test_xdelta_impl_diff_uses_correct_system_arguments_when_old_file_is_not_there(self):
         original_run_command = self.xdelta_test_class.run_command
         self.xdelta_test_class.run_command = Mock()
@@ -677,3 +2083,162 @@ class TestXDelta3DirPatcher(unittest.TestCase):
                                                         'target'])
 
         self.xdelta_test_class.run_command = original_run_command
+
+    def test_xdelta_impl_diff_stream_pipes_content_into_stdin(self):
+        original_popen = self.patcher.Popen
+
+        process = Mock()
+        process.returncode = 0
+        process.communicate = Mock(return_value = (None, b''))
+        self.patcher.Popen = Mock(return_value = process)
+
+        try:
+            write_new = Mock()
+            self.xdelta_test_class.diff_stream("old", write_new,
+                                               path.join(self.temp_dir,
+                                                         'target'))
+        finally:
+            popen = self.patcher.Popen
+            self.patcher.Popen = original_popen
+
+        self.assertEqual(['xdelta3', '-f', '-e', '-c', '-s', 'old'],
+                         popen.call_args[0][0])
+        write_new.assert_called_once_with(process.stdin)
+
+    def test_xdelta_impl_diff_stream_raises_on_failure(self):
+        original_popen = self.patcher.Popen
+
+        process = Mock()
+        process.returncode = 1
+        process.communicate = Mock(return_value = (None, b'failed'))
+        self.patcher.Popen = Mock(return_value = process)
+
+        try:
+            with self.assertRaises(CalledProcessError):
+                self.xdelta_test_class.diff_stream(None, Mock(),
+                                                   path.join(self.temp_dir,
+                                                             'target'))
+        finally:
+            self.patcher.Popen = original_popen
+
+    # ------------------- XDeltaLibImpl tests
+    class FakeXDelta3Library(object):
+        usize_t = ctypes.c_uint64
+
+        def __init__(self):
+            self.calls = []
+
+        def _run(self, name, output, input_data, source, buf, size_ptr, avail):
+            self.calls.append((name, avail))
+            if len(output) > avail:
+                return errno.ENOSPC
+
+            ctypes.memmove(buf, output, len(output))
+            size_ptr._obj.value = len(output)
+            return 0
+
+        def xd3_encode_memory(self, input_data, input_size, source, source_size,
+                              buf, size_ptr, avail, flags):
+            output = b'DELTA' + (source or b'')[:1] + input_data
+            return self._run('encode', output, input_data, source, buf,
+                             size_ptr, avail)
+
+        def xd3_decode_memory(self, input_data, input_size, source, source_size,
+                              buf, size_ptr, avail, flags):
+            # Force a few buffer growths
+            output = input_data[6:] * 10000
+            return self._run('decode', output, input_data, source, buf,
+                             size_ptr, avail)
+
+    def _with_fake_library(self):
+        lib_class = self.patcher.XDelta3LibImpl
+        fake_library = self.FakeXDelta3Library()
+
+        original_library = lib_class._library
+        lib_class._library = fake_library
+        self.addCleanup(setattr, lib_class, '_library', original_library)
+
+        return fake_library
+
+    def test_xdelta_lib_impl_encodes_and_decodes_in_process(self):
+        fake_library = self._with_fake_library()
+        lib_class = self.patcher.XDelta3LibImpl
+
+        old_file = path.join(self.temp_dir, 'old')
+        new_file = path.join(self.temp_dir, 'new')
+        delta_file = path.join(self.temp_dir, 'delta')
+        output_file = path.join(self.temp_dir, 'output')
+
+        with open(old_file, 'wb') as file_handle:
+            file_handle.write(b'old')
+        with open(new_file, 'wb') as file_handle:
+            file_handle.write(b'new')
+
+        lib_class.diff(old_file, new_file, delta_file)
+        self.assertEqual(b'DELTAonew', TestHelpers.get_content(delta_file))
+
+        lib_class.apply(old_file, delta_file, output_file)
+        self.assertEqual(b'new' * 10000, TestHelpers.get_content(output_file))
+
+        decode_calls = [call for call in fake_library.calls
+                        if call[0] == 'decode']
+        self.assertTrue(len(decode_calls) > 1)
+        self.assertTrue(decode_calls[-1][1] > decode_calls[0][1])
+
+    def test_xdelta_lib_impl_uses_cli_for_big_files(self):
+        fake_library = self._with_fake_library()
+        lib_class = self.patcher.XDelta3LibImpl
+
+        original_max_size = lib_class.MAX_IN_MEMORY_SIZE
+        original_run_command = self.xdelta_test_class.run_command
+        lib_class.MAX_IN_MEMORY_SIZE = 1
+        self.xdelta_test_class.run_command = Mock()
+
+        try:
+            new_file = path.join(self.temp_dir, 'new')
+            with open(new_file, 'wb') as file_handle:
+                file_handle.write(b'new')
+
+            lib_class.diff(None, new_file, 'target')
+        finally:
+            lib_class.MAX_IN_MEMORY_SIZE = original_max_size
+            run_command = self.xdelta_test_class.run_command
+            self.xdelta_test_class.run_command = original_run_command
+
+        run_command.assert_called_once_with(['xdelta3', '-f', '-e',
+                                             new_file, 'target'])
+        self.assertEqual([], fake_library.calls)
+
+    def test_xdelta_lib_impl_falls_back_to_cli_on_library_errors(self):
+        fake_library = self._with_fake_library()
+        lib_class = self.patcher.XDelta3LibImpl
+
+        # XD3_INTERNAL
+        fake_library.xd3_encode_memory = Mock(return_value = -17710)
+        fake_library.xd3_decode_memory = Mock(return_value = -17710)
+
+        old_file = path.join(self.temp_dir, 'old')
+        new_file = path.join(self.temp_dir, 'new')
+        for filename in [old_file, new_file]:
+            with open(filename, 'wb') as file_handle:
+                file_handle.write(b'content')
+
+        original_run_command = self.xdelta_test_class.run_command
+        self.xdelta_test_class.run_command = Mock()
+        try:
+            lib_class.diff(old_file, new_file, 'delta')
+            lib_class.apply(old_file, new_file, 'output')
+            run_command = self.xdelta_test_class.run_command
+        finally:
+            self.xdelta_test_class.run_command = original_run_command
+
+        self.assertEqual([['xdelta3', '-f', '-e', '-s', old_file, new_file,
+                           'delta'],
+                          ['xdelta3', '-f', '-d', '-s', old_file, new_file,
+                           'output']],
+                         [call[0][0] for call in run_command.call_args_list])
+
+        # Corrupt deltas are not retried
+        fake_library.xd3_decode_memory = Mock(return_value = -17712)
+        self.assertRaises(RuntimeError, lib_class.apply, old_file, new_file,
+                          'output')
@@ -18,13 +18,14 @@
 #   Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301
 #   USA
 
+import hashlib
 import imp
 import unittest
 
 from mock import Mock
 from shutil import rmtree, copyfile, copytree
 from tempfile import mkdtemp
-from os import path, chmod, makedirs, walk, lstat
+from os import path, chmod, link, makedirs, walk, lstat
 from stat import S_IRWXU, S_IRWXG, S_IROTH, S_IXOTH, S_IMODE
 
 from .test_helpers import TestHelpers
@@ -64,6 +65,47 @@ class TestXDelta3DirPatcherFsImpl(unittest.TestCase):
         self.assertFalse(self.test_class.can_open(file_pattern % '.zip'))
         self.assertFalse(self.test_class.can_open('abcd'))
 
+    def test_parallel_listing_matches_serial_one(self):
+        archive = self.get_archive('new_version1')
+        with self.test_class(archive) as test_object:
+            expected_members = test_object.list_items()
+
+        self.test_class.SCAN_THREADS = 4
+        try:
+            with self.test_class(archive) as test_object:
+                actual_members = test_object.list_items()
+        finally:
+            self.test_class.SCAN_THREADS = 1
+
+        TestHelpers.verify_new_version1_members(self, self.patcher,
+                                                actual_members)
+
+        self.assertEqual(list(expected_members.keys()),
+                         list(actual_members.keys()))
+        for name, member in expected_members.items():
+            self.assertEqual(member.name, actual_members[name].name)
+            self.assertEqual(member.permissions,
+                             actual_members[name].permissions)
+
+            if member.is_dir:
+                self.assertEqual(len(member.dirs), len(actual_members[name].dirs))
+                self.assertEqual(len(member.files), len(actual_members[name].files))
+
+    def test_user_and_group_lookups_are_cached(self):
+        self.patcher.lookup_user.cache_clear()
+        self.patcher.lookup_group.cache_clear()
+
+        archive = self.get_archive('new_version1')
+        with self.test_class(archive) as test_object:
+            file_obj = test_object.list_items()['long_lorem.txt']
+
+            self.assertEqual(file_obj.uname,
+                             self.patcher.lookup_user(file_obj.uid))
+
+        # All test files belong to the same user
+        self.assertEqual(1, self.patcher.lookup_user.cache_info().currsize)
+        self.assertEqual(1, self.patcher.lookup_group.cache_info().currsize)
+
     def test_can_list_members_correctly(self):
         archive = self.get_archive('new_version1')
         with self.test_class(archive) as test_object:
@@ -181,6 +223,47 @@ class TestXDelta3DirPatcherFsImpl(unittest.TestCase):
 
         TestHelpers.compare_trees(self, source_dir, self.temp_dir2)
 
+    def test_hardlinks_point_to_first_path_of_the_group(self):
+        archive = path.join(self.temp_dir, 'linked')
+        makedirs(path.join(archive, 'b'))
+
+        with open(path.join(archive, 'b', 'file'), 'w') as test_file:
+            test_file.write('linked content')
+        link(path.join(archive, 'b', 'file'), path.join(archive, 'a file'))
+        link(path.join(archive, 'b', 'file'), path.join(archive, 'c file'))
+        with open(path.join(archive, 'single'), 'w') as test_file:
+            test_file.write('single content')
+
+        with self.test_class(archive) as test_object:
+            members = test_object.list_items()
+
+            self.assertIsNone(members['a file'].hardlink)
+            self.assertEqual(members['b/file'].hardlink, 'a file')
+            self.assertEqual(members['c file'].hardlink, 'a file')
+            self.assertIsNone(members['single'].hardlink)
+
+    def test_hash_member_matches_content_hash(self):
+        archive = self.get_archive('new_version1')
+        content_path = path.join(archive, 'new folder', 'new file1.txt')
+        expected_hash = hashlib.sha256(TestHelpers.get_content(content_path)) \
+                               .hexdigest()
+
+        with self.test_class(archive) as test_object:
+            self.assertEqual(test_object.hash_member('new folder/new file1.txt'),
+                             expected_hash)
+
+            member = test_object.list_items()['new folder/new file1.txt']
+            self.assertEqual(member.size, lstat(content_path).st_size)
+            self.assertEqual(member.mtime, int(lstat(content_path).st_mtime))
+
+    def test_local_path_is_only_available_for_regular_files(self):
+        archive = self.get_archive('new_version1')
+
+        with self.test_class(archive) as test_object:
+            self.assertEqual(test_object.local_path('new folder/new file1.txt'),
+                             path.join(archive, 'new folder', 'new file1.txt'))
+            self.assertIsNone(test_object.local_path('new folder'))
+
     # ---------------------------- PERMISSIONS TESTS -----------------------------
     # XXX: Since permissions aren't preserved in git nor are they settable
     #      in tests, it's not feasible to create robust run-anywhere tests
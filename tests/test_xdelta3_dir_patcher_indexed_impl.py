@@ -0,0 +1,152 @@
+#    xdelta3-dir-patcher
+#    Copyright (C) 2014-2015 Endless Mobile
+#
+#   This library is free software; you can redistribute it and/or
+#   modify it under the terms of the GNU Lesser General Public
+#   License as published by the Free Software Foundation; either
+#   version 2.1 of the License, or (at your option) any later version.
+#
+#   This library is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#   Lesser General Public License for more details.
+#
+#   You should have received a copy of the GNU Lesser General Public
+#   License along with this library; if not, write to the Free Software
+#   Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301
+#   USA
+
+import hashlib
+import imp
+import unittest
+
+from io import BytesIO
+from shutil import rmtree
+from tempfile import mkdtemp
+from os import path, chmod, remove
+from stat import S_IRWXU, S_IRWXG, S_IROTH, S_IXOTH
+
+from .test_helpers import TestHelpers
+
+class TestXDelta3DirPatcherIndexedImpl(unittest.TestCase):
+    # Dashes are standard for exec scipts but not allowed for modules in Python. We
+    # use the script standard since we will be running that file as a script most
+    # often.
+    patcher = imp.load_source("xdelta3-dir-patcher", "xdelta3-dir-patcher")
+
+    TEST_FILE_PREFIX = path.join('tests', 'test_files', 'tar_impl')
+
+    def setUp(self):
+        self.temp_dir = mkdtemp(prefix="%s_" % self.__class__.__name__)
+        chmod(self.temp_dir, S_IRWXU | S_IRWXG | S_IROTH | S_IXOTH)
+        self.temp_dir2 = mkdtemp(prefix="%s_" % self.__class__.__name__)
+        chmod(self.temp_dir2, S_IRWXU | S_IRWXG | S_IROTH | S_IXOTH)
+
+        self.test_class = self.patcher.XDelta3IndexedImpl
+
+    def tearDown(self):
+        rmtree(self.temp_dir)
+        rmtree(self.temp_dir2)
+
+    def create_archive(self, name):
+        archive = path.join(self.temp_dir, 'test_archive.idx')
+        source_dir = path.join(self.TEST_FILE_PREFIX, name)
+
+        with self.test_class(archive, True) as test_object:
+            test_object.create(source_dir)
+
+        return archive
+
+    def test_can_open_works(self):
+        archive = self.create_archive('new_version1')
+        prefix = path.join('tests', 'test_files', 'archive_instance')
+        file_pattern = path.join(prefix, 'old_version1%s')
+
+        self.assertTrue(self.test_class.can_open(archive))
+        self.assertFalse(self.test_class.can_open(file_pattern % ''))
+        self.assertFalse(self.test_class.can_open(file_pattern % '.tgz'))
+        self.assertFalse(self.test_class.can_open(file_pattern % '.zip'))
+        self.assertFalse(self.test_class.can_open('abcd'))
+
+    def test_archive_instance_detects_indexed_bundles(self):
+        archive = self.create_archive('new_version1')
+
+        with self.patcher.XDeltaArchive(archive) as archive_instance:
+            self.assertEquals(archive_instance.__class__, self.test_class)
+
+    def test_can_list_members_correctly(self):
+        archive = self.create_archive('new_version1')
+
+        with self.test_class(archive) as test_object:
+            TestHelpers.verify_new_version1_members(self, self.patcher,
+                                                    test_object.list_items())
+
+    def test_can_create_and_expand_correctly(self):
+        archive = self.create_archive('new_version1')
+        source_dir = path.join(self.TEST_FILE_PREFIX, 'new_version1')
+
+        with self.test_class(archive) as test_object:
+            test_object.expand(None, self.temp_dir2)
+
+        TestHelpers.compare_trees(self, source_dir, self.temp_dir2)
+
+    def test_symbolic_links_are_handled_correctly(self):
+        archive = self.create_archive('symlink')
+        source_dir = path.join(self.TEST_FILE_PREFIX, 'symlink')
+
+        with self.test_class(archive) as test_object:
+            test_object.expand(None, self.temp_dir2)
+
+        TestHelpers.compare_trees(self, source_dir, self.temp_dir2)
+
+    def test_single_members_are_read_from_the_index(self):
+        archive = self.create_archive('new_version1')
+        content = b'new file content\n'
+
+        with self.test_class(archive) as test_object:
+            member = test_object.list_items()['new folder/new file1.txt']
+            self.assertEqual(len(content), member.size)
+            self.assertEqual(hashlib.sha256(content).hexdigest(),
+                             test_object.hash_member('new folder/new file1.txt'))
+
+            output = BytesIO()
+            test_object.copy_member('new folder/new file1.txt', output)
+            self.assertEqual(content, output.getvalue())
+
+            test_object.expand('new folder/new file1.txt', self.temp_dir2)
+
+        expanded_path = path.join(self.temp_dir2, 'new folder', 'new file1.txt')
+        self.assertEqual(content, TestHelpers.get_content(expanded_path))
+
+    def test_deflated_members_are_read_transparently(self):
+        content = b'compressible content ' * 1000
+        source_path = path.join(self.temp_dir2, 'source_file')
+        with open(source_path, 'wb') as source_file:
+            source_file.write(content)
+
+        archive = path.join(self.temp_dir, 'test_archive.idx')
+        with self.test_class(archive, True) as test_object:
+            test_object.add(source_path, 'file', deflate = True)
+
+        with self.test_class(archive) as test_object:
+            record = test_object.list_items()['file'].data
+            self.assertEqual('zlib', record['compression'])
+            self.assertLess(record['length'], len(content))
+
+            output = BytesIO()
+            test_object.copy_member('file', output)
+            self.assertEqual(content, output.getvalue())
+
+    def test_incompressible_members_are_stored_even_if_deflate_is_asked(self):
+        source_path = path.join(self.temp_dir2, 'source_file')
+        with open(source_path, 'wb') as source_file:
+            source_file.write(b'x')
+
+        archive = path.join(self.temp_dir, 'test_archive.idx')
+        with self.test_class(archive, True) as test_object:
+            test_object.add(source_path, 'file', deflate = True)
+
+        with self.test_class(archive) as test_object:
+            record = test_object.list_items()['file'].data
+            self.assertNotIn('compression', record)
+            self.assertEqual(1, record['length'])
@@ -16,11 +16,13 @@
 #   Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301
 #   USA
 
+import hashlib
 import imp
 import unittest
 import tarfile
 
 from collections import OrderedDict
+from io import BytesIO
 from mock import Mock
 from shutil import rmtree, copyfile
 from tempfile import mkdtemp
@@ -243,6 +245,147 @@ class TestXDelta3DirPatcherTarImpl(unittest.TestCase):
 
         TestHelpers.compare_trees(self, source_dir, self.temp_dir2)
 
+    def test_hash_member_matches_content_hash(self):
+        archive = self.get_archive('new_version1')
+        content_path = path.join(self.TEST_FILE_PREFIX, 'new_version1',
+                                 'new folder', 'new file1.txt')
+        expected_hash = hashlib.sha256(TestHelpers.get_content(content_path)) \
+                               .hexdigest()
+
+        with self.test_class(archive) as test_object:
+            self.assertEqual(test_object.hash_member('new folder/new file1.txt'),
+                             expected_hash)
+
+            member = test_object.list_items()['new folder/new file1.txt']
+            self.assertEqual(member.size, len(b'new file content\n'))
+            self.assertIsNotNone(member.mtime)
+
+    def test_stream_items_expands_files_in_archive_order(self):
+        archive = self.get_archive('new_version1')
+
+        with self.test_class(archive) as test_object:
+            names = [name for name in test_object.list_items() if name]
+            requested_names = list(reversed(names))
+
+            streamed = list(test_object.stream_items(requested_names,
+                                                     self.temp_dir))
+
+            self.assertEqual(names, [name for name, _ in streamed])
+
+            for name, expanded in streamed:
+                member = test_object.list_items()[name]
+                self.assertEqual(member.is_file, expanded)
+
+                if expanded:
+                    self.assertTrue(path.isfile(path.join(self.temp_dir, name)))
+
+    def test_stream_items_yields_missing_hierarchy_last(self):
+        archive = self.get_archive('missing_hierarchy')
+
+        with self.test_class(archive) as test_object:
+            streamed = list(test_object.stream_items(['foo/bar',
+                                                      'foo/bar/baz/foo/bar/baz/test.txt'],
+                                                     self.temp_dir))
+
+        self.assertEqual([('foo/bar/baz/foo/bar/baz/test.txt', True),
+                          ('foo/bar', False)],
+                         streamed)
+
+    def test_copy_member_writes_content_without_extracting(self):
+        archive = self.get_archive('new_version1')
+
+        with self.test_class(archive) as test_object:
+            output = BytesIO()
+            test_object.copy_member('new folder/new file1.txt', output)
+
+            self.assertEqual(b'new file content\n', output.getvalue())
+            self.assertIsNone(test_object.local_path('new folder/new file1.txt'))
+
+    def test_hardlink_members_are_listed_with_their_target(self):
+        archive = path.join(self.temp_dir, 'linked.tar')
+
+        with tarfile.open(archive, 'w') as archive_file:
+            data = b'linked content'
+            info = tarfile.TarInfo('folder/file')
+            info.size = len(data)
+            archive_file.addfile(info, BytesIO(data))
+
+            info = tarfile.TarInfo('folder/link')
+            info.type = tarfile.LNKTYPE
+            info.linkname = 'folder/file'
+            archive_file.addfile(info)
+
+        with self.test_class(archive) as test_object:
+            members = test_object.list_items()
+
+            self.assertIsNone(members['folder/file'].hardlink)
+            self.assertEqual(members['folder/link'].hardlink, 'folder/file')
+
+    def test_deflated_members_are_read_transparently(self):
+        content = b'compressible content ' * 1000
+        source_path = path.join(self.temp_dir2, 'source_file')
+        with open(source_path, 'wb') as source_file:
+            source_file.write(content)
+
+        archive = path.join(self.temp_dir2, 'bundle.tar')
+        with self.patcher.XDelta3BundleWriter(archive,
+                                              compression = 'auto') as writer:
+            writer.add(source_path, 'file', remove_source = False)
+
+        with self.test_class(archive) as test_object:
+            self.assertEqual(len(content), test_object.list_items()['file'].size)
+            self.assertEqual(hashlib.sha256(content).hexdigest(),
+                             test_object.hash_member('file'))
+
+            test_object.expand('file', self.temp_dir)
+
+        self.assertEqual(content,
+                         TestHelpers.get_content(path.join(self.temp_dir, 'file')))
+
+    @unittest.skipIf(patcher.zstandard is None, 'zstandard module is missing')
+    def test_zstd_archives_are_streamed_and_spooled_for_random_access(self):
+        source_path = path.join(self.temp_dir2, 'source_file')
+        with open(source_path, 'wb') as source_file:
+            source_file.write(b'file content')
+
+        archive = path.join(self.temp_dir2, 'bundle.tzst')
+        with self.patcher.XDelta3BundleWriter(archive,
+                                              compression = 'zstd') as writer:
+            writer.add(source_path, 'top', remove_source = False)
+            writer.add(source_path, 'folder/nested', remove_source = False)
+
+        spool_dir = path.join(self.temp_dir2, 'spool')
+        makedirs(spool_dir)
+
+        with self.test_class(archive) as test_object:
+            test_object.spool_dir = spool_dir
+
+            self.assertIn('folder/nested', test_object.list_items())
+
+            streamed = list(test_object.stream_items(['folder/nested'],
+                                                     self.temp_dir))
+            self.assertEqual([('folder/nested', True)], streamed)
+            self.assertEqual(b'file content',
+                             TestHelpers.get_content(path.join(self.temp_dir,
+                                                               'folder/nested')))
+
+            # Small top-level members are kept from the listing
+            output = BytesIO()
+            test_object.copy_member('top', output)
+            self.assertEqual(b'file content', output.getvalue())
+
+            self.assertIsNone(test_object.archive_object)
+            self.assertEqual([], listdir(spool_dir))
+
+            test_object.expand('folder/nested', self.temp_dir2)
+
+            self.assertIsNotNone(test_object.archive_object)
+            self.assertEqual(1, len(listdir(spool_dir)))
+
+        self.assertEqual(b'file content',
+                         TestHelpers.get_content(path.join(self.temp_dir2,
+                                                           'folder/nested')))
+
     # XXX: tarfile implementation is not thread-safe after trying it out
     @unittest.skipIf(cpu_count() <= 3, \
                      'This test requires 3 or more virtal CPUs')
@@ -16,6 +16,7 @@
 #   Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301
 #   USA
 
+import hashlib
 import imp
 import unittest
 import zipfile
@@ -162,3 +163,17 @@ class TestXDelta3DirPatcherZipImpl(unittest.TestCase):
             archive_object.extractall(self.temp_dir2)
 
         TestHelpers.compare_trees(self, source_dir, self.temp_dir2)
+
+    def test_hash_member_matches_content_hash(self):
+        archive = self.get_archive('new_version1')
+        content_path = path.join(self.TEST_FILE_PREFIX, 'new_version1',
+                                 'new folder', 'new file1.txt')
+        expected_hash = hashlib.sha256(TestHelpers.get_content(content_path)) \
+                               .hexdigest()
+
+        with self.test_class(archive) as test_object:
+            self.assertEqual(test_object.hash_member('new folder/new file1.txt'),
+                             expected_hash)
+
+            member = test_object.list_items()['new folder/new file1.txt']
+            self.assertEqual(member.size, len(b'new file content\n'))